@@ -0,0 +1,78 @@
+"""
+Benchmarks the kg.py save functions against a temporary DuckDB database.
+
+Run with `python tests/benchmark_ids.py`. Every measurement starts from an
+empty database and saves rows with distinct names, so each row allocates new
+ids.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "truth"))
+
+import database  # noqa: E402
+from canonical import CANONICAL_IDS  # noqa: E402
+from kg import load_schema_registry, save_graph, save_objs  # noqa: E402
+from schema.places import CapitalRelation, City, Country  # noqa: E402
+from schema.topics import Topic  # noqa: E402
+from sqlmodel import SQLModel  # noqa: E402
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+
+def fresh_database(directory, name):
+    """Points the pool at a new, empty database with the schema created."""
+    database.DATABASE_URL = f"duckdb:///{os.path.join(directory, name)}.db"
+    database.configure_pool(database.POOL_SIZE)
+    database.engine.echo = False
+    database.ID_ALLOCATOR = database.IdAllocator()
+    for model_class in (Country, City, Topic):
+        CANONICAL_IDS.forget(model_class)
+    SQLModel.metadata.create_all(database.engine)
+    load_schema_registry()
+
+
+def graph_rows(n):
+    return [[f"Country {i}", f"City {i}"] for i in range(n)]
+
+
+def topic_rows(n):
+    return [(f"Topic {i}",) for i in range(n)]
+
+
+def timed(save, rows):
+    """Returns the wall-clock time of one save call, in seconds."""
+    start = time.perf_counter()
+    asyncio.run(save(rows))
+    return time.perf_counter() - start
+
+
+def benchmarks():
+    return {
+        "save_graph": (
+            lambda rows: save_graph(rows, Country, City, CapitalRelation),
+            graph_rows,
+        ),
+        "save_objs": (lambda rows: save_objs(rows, Topic), topic_rows),
+    }
+
+
+def main():
+    """Prints the scaling curve as a table of total and per-row times."""
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'function':<16} {'rows':>10} {'s':>10} {'us/row':>10}")
+        for label, (save, make_rows) in benchmarks().items():
+            for n in SIZES:
+                fresh_database(directory, f"{label}_{n}")
+                rows = make_rows(n)
+                elapsed = timed(save, rows)
+                print(f"{label:<16} {n:>10} {elapsed:10.3f} {elapsed / n * 1e6:10.1f}")
+        database.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
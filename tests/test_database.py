@@ -0,0 +1,39 @@
+import json
+import os
+import subprocess
+import sys
+
+TRUTH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "truth"))
+
+ALLOCATE = f"""
+import json, sys
+sys.path.insert(0, {TRUTH!r})
+import database
+from sqlmodel import SQLModel
+import kg  # noqa: F401, registers the global id sequence
+
+database.engine.echo = False
+SQLModel.metadata.create_all(database.engine)
+print(json.dumps(database.allocate_ids(3)))
+"""
+
+
+def allocate_in_new_process(directory):
+    """Allocates three ids in a fresh interpreter using directory's kg.db."""
+    result = subprocess.run(
+        [sys.executable, "-c", ALLOCATE],
+        cwd=directory,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_allocate_ids_never_reissues_across_processes(tmp_path):
+    """Test that a second process is not handed the ids of the first."""
+    first = allocate_in_new_process(tmp_path)
+    second = allocate_in_new_process(tmp_path)
+    assert len(set(first)) == 3
+    assert not set(first) & set(second)
+    assert min(second) > max(first)
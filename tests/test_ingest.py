@@ -0,0 +1,127 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+from pandas import DataFrame
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "truth"))
+
+import database  # noqa: E402
+import kg  # noqa: E402
+from adjacency import AdjacencyIndex  # noqa: E402
+from canonical import CANONICAL_IDS  # noqa: E402
+from ingest import IngestQueue  # noqa: E402
+from kg import load_schema_registry, save_graph  # noqa: E402
+from schema.places import CapitalRelation, City, Country  # noqa: E402
+from schema.topics import Topic  # noqa: E402
+from sqlmodel import SQLModel  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_database(tmp_path, monkeypatch):
+    """Points the pool at a new, empty database with the schema created."""
+    monkeypatch.setattr(database, "DATABASE_URL", f"duckdb:///{tmp_path}/kg.db")
+    database.configure_pool(database.POOL_SIZE)
+    database.engine.echo = False
+    monkeypatch.setattr(database, "ID_ALLOCATOR", database.IdAllocator())
+    monkeypatch.setattr(kg, "ADJACENCY", AdjacencyIndex(f"{tmp_path}/kg.adj.npz"))
+    for model_class in (Country, City, Topic):
+        CANONICAL_IDS.forget(model_class)
+    SQLModel.metadata.create_all(database.engine)
+    load_schema_registry()
+    yield
+    database.engine.dispose()
+
+
+def query(sql):
+    with database.pooled_connection() as duck:
+        return duck.execute(sql).fetchall()
+
+
+def topics_frame(*names):
+    ids = database.allocate_ids(len(names))
+    return ("topics", DataFrame({"name": list(names), "id": ids}))
+
+
+BAD_FRAME = ("relations", DataFrame({"no_such_column": [1]}))
+
+
+async def test_bad_batch_fails_only_its_caller():
+    """Test that a group with one bad batch still commits the others."""
+    queue = IngestQueue(max_delay_ms=50)
+    good = asyncio.create_task(queue.submit([topics_frame("Physics", "Chemistry")]))
+    bad = asyncio.create_task(queue.submit([topics_frame("Biology"), BAD_FRAME]))
+    assert await good == 2
+    with pytest.raises(Exception):
+        await bad
+    names = query("SELECT name FROM topics ORDER BY name")
+    assert names == [("Chemistry",), ("Physics",)]
+
+
+async def test_future_resolves_after_commit():
+    """Test that submitted rows are visible to other connections on return."""
+    queue = IngestQueue()
+    assert await queue.submit([topics_frame("Physics")]) == 1
+    assert queue.commits == 1
+    assert query("SELECT name FROM topics") == [("Physics",)]
+
+
+async def test_concurrent_saves_of_one_edge_insert_it_once():
+    """Test that concurrent saves of one edge share its nodes and its row."""
+    rows = [["France", "Paris"]]
+    saves = [save_graph(rows, Country, City, CapitalRelation) for _ in range(5)]
+    await asyncio.gather(*saves)
+    assert query("SELECT count(*) FROM countries") == [(1,)]
+    assert query("SELECT count(*) FROM cities") == [(1,)]
+    edges = query(
+        f"SELECT count(*) FROM relations WHERE rtype = {CapitalRelation.TYPE.id}"
+    )
+    assert edges == [(1,)]
+
+
+async def test_edge_keeps_its_node_when_the_owning_save_fails(monkeypatch):
+    """Test that a save reusing a node of a failed save still inserts it."""
+    graph_frames, new_edges = kg.graph_frames, kg.new_edges
+    lyon_canonicalized = threading.Event()
+
+    def cities_id(name):
+        return CANONICAL_IDS.ids.get(City, {}).get(name.lower())
+
+    def fail_paris(held_nodes, *args, **kwargs):
+        frames = graph_frames(held_nodes, *args, **kwargs)
+        if ("Paris", cities_id("Paris")) in dict(held_nodes)[City]:
+            frames.append(BAD_FRAME)
+        return frames
+
+    # The Paris save waits for the Lyon save to resolve France, so both hold it
+    def paris_after_lyon(rtype, pairs, viewpoint=0):
+        if pairs[0][1] == cities_id("Lyon"):
+            lyon_canonicalized.set()
+        else:
+            lyon_canonicalized.wait(5)
+        return new_edges(rtype, pairs, viewpoint)
+
+    monkeypatch.setattr(kg, "graph_frames", fail_paris)
+    monkeypatch.setattr(kg, "new_edges", paris_after_lyon)
+    # The Paris save allocates France's id before the Lyon save starts
+    paris = asyncio.create_task(
+        save_graph([["France", "Paris"]], Country, City, CapitalRelation)
+    )
+    while cities_id("Paris") is None:
+        await asyncio.sleep(0.001)
+    lyon = save_graph([["France", "Lyon"]], Country, City, CapitalRelation)
+    results = await asyncio.gather(paris, lyon, return_exceptions=True)
+    assert isinstance(results[0], Exception)
+    assert results[1] == 1
+    dangling = query(
+        """
+        SELECT count(*) FROM relations r
+        WHERE rtype = (SELECT id FROM property_types WHERE name = 'CapitalRelation')
+        AND (r.src NOT IN (SELECT id FROM countries)
+             OR r.dst NOT IN (SELECT id FROM cities))
+        """
+    )
+    assert dangling == [(0,)]
+    assert query("SELECT name FROM cities") == [("Lyon",)]
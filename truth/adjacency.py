@@ -0,0 +1,405 @@
+# In-memory CSR adjacency over the relations table, so one-hop lookups don't
+# scan DuckDB. The compacted arrays are persisted beside kg.db; edges written
+# since the last compaction are kept in dicts and merged in batches on a
+# background thread.
+
+import atexit
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from threading import Lock
+
+import numpy as np
+from database import DATABASE_PATH, pooled_connection
+from pandas import DataFrame
+
+ADJACENCY_PATH = os.path.splitext(DATABASE_PATH)[0] + ".adj.npz"
+# Number of pending edges that triggers a merge into the CSR arrays
+COMPACT_THRESHOLD = 65536
+INFINITY_DAY = np.datetime64(date.max, "D")
+
+EDGE_DTYPES = {
+    "src": np.int64,
+    "rtype": np.int64,
+    "dst": np.int64,
+    "start": "datetime64[D]",
+    "end": "datetime64[D]",
+    "viewpoint": np.int64,
+}
+
+
+def concat_edges(a, b):
+    return {column: np.concatenate([a[column], b[column]]) for column in EDGE_DTYPES}
+
+
+def edge_arrays(edges):
+    columns = list(zip(*edges))
+    return {
+        column: np.array(values, dtype)
+        for (column, dtype), values in zip(EDGE_DTYPES.items(), columns)
+    }
+
+
+def read_relations():
+    # end is stored as text by fquery; NULL or unparsable ends never expire
+    statement = f"""
+        SELECT src, rtype, dst, start,
+            COALESCE(TRY_CAST("end" AS DATE), DATE '{date.max}') AS "end",
+            COALESCE(viewpoint, 0) AS viewpoint
+        FROM relations
+    """
+    with pooled_connection() as duck:
+        edges = duck.execute(statement).fetchnumpy()
+    return {
+        column: np.asarray(edges[column]).astype(dtype)
+        for column, dtype in EDGE_DTYPES.items()
+    }
+
+
+# The row count and the sums of the integer columns, modulo 2**64. The .npz
+# stores the same numbers for its arrays, so a kg.db that was recreated or
+# edited since the arrays were saved is noticed even when the count matches.
+FINGERPRINT_COLUMNS = ("src", "rtype", "dst", "viewpoint", "start")
+
+
+def relations_fingerprint() -> np.ndarray:
+    statement = """
+        SELECT count(*), sum(src), sum(rtype), sum(dst),
+            sum(COALESCE(viewpoint, 0)), sum(start - DATE '1970-01-01')
+        FROM relations
+    """
+    with pooled_connection() as duck:
+        row = duck.execute(statement).fetchone()
+    return np.array([int(value or 0) % 2**64 for value in row], dtype=np.uint64)
+
+
+def edges_fingerprint(edges) -> np.ndarray:
+    sums = [
+        edges[column].astype(np.int64).sum(dtype=np.uint64)
+        for column in FINGERPRINT_COLUMNS
+    ]
+    return np.array([len(edges["src"]), *sums], dtype=np.uint64)
+
+
+def select_edges(edges, index):
+    return {column: array[index] for column, array in edges.items()}
+
+
+# (key, rtype, start) per edge as one structured array, which numpy compares
+# field by field, so sorted edges can be searched in that order
+def sort_keys(key, edges) -> np.ndarray:
+    keys = np.empty(
+        len(edges[key]),
+        dtype=[("key", np.int64), ("rtype", np.int64), ("start", np.int64)],
+    )
+    keys["key"] = edges[key]
+    keys["rtype"] = edges["rtype"]
+    keys["start"] = edges["start"].astype(np.int64)
+    return keys
+
+
+# Edges sorted by (key, rtype, start) with one offset per distinct key value
+class CSR:
+    def __init__(self, key, edges, presorted=False):
+        if not presorted:
+            order = np.lexsort((edges["start"], edges["rtype"], edges[key]))
+            edges = {column: array[order] for column, array in edges.items()}
+        self.key = key
+        self.edges = edges
+        values = edges[key]
+        first = np.ones(len(values), dtype=bool)
+        first[1:] = values[1:] != values[:-1]
+        starts = np.flatnonzero(first)
+        self.keys = values[starts]
+        self.offsets = np.append(starts, len(values))
+
+    # A new CSR with edges added. Only the new edges are sorted; they are then
+    # inserted at their searchsorted positions, so a merge costs O(E) rather
+    # than a full O(E log E) re-sort.
+    def merge(self, edges) -> "CSR":
+        order = np.lexsort((edges["start"], edges["rtype"], edges[self.key]))
+        edges = select_edges(edges, order)
+        positions = np.searchsorted(
+            sort_keys(self.key, self.edges), sort_keys(self.key, edges), side="right"
+        )
+        merged = {
+            column: np.insert(array, positions, edges[column])
+            for column, array in self.edges.items()
+        }
+        return CSR(self.key, merged, presorted=True)
+
+    # With an rtype and as_of, the slice is also cut down to edges starting on
+    # or before as_of, since starts are sorted within each (key, rtype) run
+    def lookup(self, value, rtype=None, as_of=None) -> slice:
+        i = np.searchsorted(self.keys, value)
+        if i == len(self.keys) or self.keys[i] != value:
+            return slice(0, 0)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        if rtype is not None:
+            rtypes = self.edges["rtype"][lo:hi]
+            lo, hi = lo + np.searchsorted(rtypes, rtype), lo + np.searchsorted(
+                rtypes, rtype, side="right"
+            )
+            if as_of is not None:
+                starts = self.edges["start"][lo:hi]
+                hi = lo + np.searchsorted(starts, as_of, side="right")
+        return slice(lo, hi)
+
+    # Positions of every edge whose key is in values, in one vectorized step
+    def gather(self, values) -> np.ndarray:
+        i = np.searchsorted(self.keys, values)
+        found = i < len(self.keys)
+        i = i[found]
+        i = i[self.keys[i] == values[found]]
+        lo = self.offsets[i]
+        counts = self.offsets[i + 1] - lo
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        return starts + np.arange(counts.sum())
+
+
+# Answers "which edges are valid on day D" without a full scan. Open-ended
+# edges are sorted by start, so the valid ones are a prefix. Closed edges are
+# kept sorted by start and by end; whichever of "start <= D" (a prefix) or
+# "end > D" (a suffix) is smaller is sliced out and filtered on the other bound.
+class IntervalIndex:
+    def __init__(self, edges):
+        is_open = edges["end"] == INFINITY_DAY
+        closed = select_edges(edges, ~is_open)
+        self.open = select_edges(edges, is_open)
+        self.open = select_edges(self.open, np.argsort(self.open["start"]))
+        self.closed_by_start = select_edges(closed, np.argsort(closed["start"]))
+        self.closed_by_end = select_edges(closed, np.argsort(closed["end"]))
+
+    def valid_on(self, day):
+        n = np.searchsorted(self.open["start"], day, side="right")
+        edges = {column: array[:n] for column, array in self.open.items()}
+        started = np.searchsorted(self.closed_by_start["start"], day, side="right")
+        ended = np.searchsorted(self.closed_by_end["end"], day, side="right")
+        if started <= len(self.closed_by_end["end"]) - ended:
+            candidates = {c: a[:started] for c, a in self.closed_by_start.items()}
+            candidates = select_edges(candidates, day < candidates["end"])
+        else:
+            candidates = {c: a[ended:] for c, a in self.closed_by_end.items()}
+            candidates = select_edges(candidates, candidates["start"] <= day)
+        return concat_edges(edges, candidates)
+
+
+class AdjacencyIndex:
+    def __init__(self, path=ADJACENCY_PATH):
+        self.path = path
+        self.loaded = False
+        self._lock = Lock()
+        # Held for a whole compaction, so merges and saves never overlap
+        self._compact_lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._compaction = None
+
+    def load(self):
+        edges = None
+        if os.path.exists(self.path):
+            with np.load(self.path) as saved:
+                current = set(EDGE_DTYPES) | {"fingerprint"} <= set(saved.files)
+                if current and np.array_equal(
+                    saved["fingerprint"], relations_fingerprint()
+                ):
+                    edges = {column: saved[column] for column in EDGE_DTYPES}
+        if edges is None:
+            edges = read_relations()
+            self._save(edges)
+        self._build(edges)
+        self.loaded = True
+
+    def _build(self, edges):
+        self.forward = CSR("src", edges)
+        self.reverse = CSR("dst", edges)
+        self.intervals = None
+        self.partitions = {}
+        self._reset_pending([])
+
+    def _reset_pending(self, pending):
+        self.pending = pending
+        self.pending_forward = defaultdict(list)
+        self.pending_reverse = defaultdict(list)
+        for edge in pending:
+            self.pending_forward[edge[0]].append(edge)
+            self.pending_reverse[edge[2]].append(edge)
+
+    def _save(self, edges):
+        np.savez(self.path, fingerprint=edges_fingerprint(edges), **edges)
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.load()
+
+    # Called by the save functions after their commit. Before the first query
+    # nothing is loaded, and the committed edges will be read from DuckDB. The
+    # caller never waits for a compaction; it runs on the executor thread.
+    def add_edges(self, src, rtype, dst, start=None, end=None, viewpoint=0):
+        if not self.loaded:
+            return
+        start = np.datetime64(start or date.today(), "D")
+        end = np.datetime64(end or date.max, "D")
+        with self._lock:
+            for s, d in zip(src, dst):
+                edge = (s, rtype, d, start, end, viewpoint)
+                self.pending.append(edge)
+                self.pending_forward[s].append(edge)
+                self.pending_reverse[d].append(edge)
+            if len(self.pending) >= COMPACT_THRESHOLD and self._compaction is None:
+                self._compaction = self._executor.submit(self._compact)
+
+    # Merges the edges pending when it starts into both CSRs, then swaps them
+    # in. Queries keep using the old arrays until the swap, and edges added in
+    # the meantime stay pending.
+    def _compact(self):
+        with self._compact_lock:
+            try:
+                with self._lock:
+                    n = len(self.pending)
+                    forward, reverse = self.forward, self.reverse
+                    added = edge_arrays(self.pending[:n]) if n else None
+                if added is None:
+                    return
+                forward, reverse = forward.merge(added), reverse.merge(added)
+                with self._lock:
+                    self.forward, self.reverse = forward, reverse
+                    self.intervals = None
+                    self.partitions = {}
+                    self._reset_pending(self.pending[n:])
+                self._save(forward.edges)
+            finally:
+                self._compaction = None
+
+    # Merges and persists every pending edge, so the next process can load the
+    # .npz instead of reading the relations table. Runs at exit.
+    def flush(self):
+        if self.loaded:
+            self._compact()
+
+    def _query(self, csr, pending, value, rtype, as_of, column):
+        day = None if as_of is None else np.datetime64(as_of, "D")
+        part = csr.lookup(value, rtype, day)
+        extra = [e for e in pending.get(value, ()) if rtype is None or e[1] == rtype]
+        if not extra and day is None:
+            return csr.edges[column][part]
+        edges = {c: csr.edges[c][part] for c in EDGE_DTYPES}
+        if extra:
+            edges = concat_edges(edges, edge_arrays(extra))
+        if day is not None:
+            # valid from start (inclusive) until end (exclusive)
+            valid = (edges["start"] <= day) & (day < edges["end"])
+            return edges[column][valid]
+        return edges[column]
+
+    # Every edge valid on as_of, as columns of the relations table
+    def edges_as_of(self, as_of, rtype=None):
+        self.ensure_loaded()
+        day = np.datetime64(as_of, "D")
+        if self.intervals is None:
+            self.intervals = IntervalIndex(self.forward.edges)
+        edges = self.intervals.valid_on(day)
+        if self.pending:
+            pending = edge_arrays(self.pending)
+            valid = (pending["start"] <= day) & (day < pending["end"])
+            edges = concat_edges(edges, select_edges(pending, valid))
+        if rtype is not None:
+            edges = select_edges(edges, edges["rtype"] == rtype)
+        return edges
+
+    # One hop from a whole frontier of ids at once
+    def expand(self, frontier, rtypes=None, as_of=None, reverse=False) -> np.ndarray:
+        self.ensure_loaded()
+        csr, column = (self.reverse, "src") if reverse else (self.forward, "dst")
+        wanted = [column]
+        if rtypes is not None:
+            wanted.append("rtype")
+        if as_of is not None:
+            wanted += ["start", "end"]
+        positions = csr.gather(frontier)
+        edges = {c: csr.edges[c][positions] for c in wanted}
+        if self.pending:
+            pending = edge_arrays(self.pending)
+            mask = np.isin(pending[csr.key], frontier)
+            edges = {c: np.concatenate([edges[c], pending[c][mask]]) for c in wanted}
+        valid = np.ones(len(edges[column]), dtype=bool)
+        if rtypes is not None:
+            valid &= np.isin(edges["rtype"], rtypes)
+        if as_of is not None:
+            day = np.datetime64(as_of, "D")
+            valid &= (edges["start"] <= day) & (day < edges["end"])
+        return edges[column][valid]
+
+    # The CSR over one viewpoint's edges, split out of the full index on first use
+    def partition(self, viewpoint) -> CSR:
+        self.ensure_loaded()
+        if viewpoint not in self.partitions:
+            edges = self.forward.edges
+            part = select_edges(edges, edges["viewpoint"] == viewpoint)
+            self.partitions[viewpoint] = CSR("src", part)
+        return self.partitions[viewpoint]
+
+    def partition_edges(self, viewpoint):
+        edges = self.partition(viewpoint).edges
+        pending = [e for e in self.pending if e[5] == viewpoint]
+        if pending:
+            edges = concat_edges(edges, edge_arrays(pending))
+        return edges
+
+    # What viewpoint believes about src: its out-edges in that partition only
+    def beliefs(self, src, viewpoint, rtype=None, as_of=None) -> np.ndarray:
+        csr = self.partition(viewpoint)
+        pending = {
+            src: [e for e in self.pending_forward.get(src, ()) if e[5] == viewpoint]
+        }
+        return self._query(csr, pending, src, rtype, as_of, "dst")
+
+    # Edges held by only one of two viewpoints, found with a single outer merge
+    # of both partitions. The viewpoint column says which side holds the edge.
+    def diff_viewpoints(self, a, b, rtype=None) -> DataFrame:
+        keys = ["src", "rtype", "dst"]
+        sides = []
+        for viewpoint in (a, b):
+            edges = self.partition_edges(viewpoint)
+            side = DataFrame({k: edges[k] for k in keys})
+            if rtype is not None:
+                side = side[side["rtype"] == rtype]
+            sides.append(side)
+        merged = sides[0].merge(sides[1], on=keys, how="outer", indicator=True)
+        merged = merged[merged["_merge"] != "both"]
+        merged["viewpoint"] = np.where(merged["_merge"] == "left_only", a, b)
+        return merged.drop(columns="_merge").reset_index(drop=True)
+
+    def neighbors(self, src, rtype=None, as_of=None) -> np.ndarray:
+        self.ensure_loaded()
+        return self._query(self.forward, self.pending_forward, src, rtype, as_of, "dst")
+
+    def reverse_neighbors(self, dst, rtype=None, as_of=None) -> np.ndarray:
+        self.ensure_loaded()
+        return self._query(self.reverse, self.pending_reverse, dst, rtype, as_of, "src")
+
+
+ADJACENCY = AdjacencyIndex()
+atexit.register(ADJACENCY.flush)
+
+
+def neighbors(src, rtype=None, as_of=None) -> np.ndarray:
+    return ADJACENCY.neighbors(src, rtype, as_of)
+
+
+def reverse_neighbors(dst, rtype=None, as_of=None) -> np.ndarray:
+    return ADJACENCY.reverse_neighbors(dst, rtype, as_of)
+
+
+def edges_as_of(as_of, rtype=None):
+    return ADJACENCY.edges_as_of(as_of, rtype)
+
+
+def beliefs(src, viewpoint, rtype=None, as_of=None) -> np.ndarray:
+    return ADJACENCY.beliefs(src, viewpoint, rtype, as_of)
+
+
+def diff_viewpoints(a, b, rtype=None) -> DataFrame:
+    return ADJACENCY.diff_viewpoints(a, b, rtype)
@@ -0,0 +1,114 @@
+# Ingest-time canonicalization: normalized name -> global id per @graph class,
+# so repeated extractions reuse nodes instead of duplicating them. A class's
+# map is loaded from its node table in DuckDB on first use and kept in memory
+# after that.
+
+import re
+from dataclasses import fields
+from threading import Lock
+from typing import Any, Dict, List, Tuple
+
+from database import allocate_ids, pooled_connection
+
+PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+def normalize(name) -> str:
+    return " ".join(PUNCTUATION.sub(" ", str(name).lower()).split())
+
+
+# normalize() as a DuckDB expression over column, for set-based matching. Only
+# rare case foldings differ (Python lowercases "İ" to "i" plus a combining dot).
+def normalize_sql(column: str) -> str:
+    stripped = f"regexp_replace(lower({column}), '[^\\p{{L}}\\p{{N}}_\\s]', ' ', 'g')"
+    return f"trim(regexp_replace({stripped}, '\\s+', ' ', 'g'))"
+
+
+# An id enters its class's map as soon as it is allocated, but its node is only
+# in the table once the save that allocated it commits. Until then the id is
+# pending, and every save that resolves a name to it holds it: a holder writes
+# the node itself (ON CONFLICT DO NOTHING), so its edges never point at a node
+# that an earlier, failed save was meant to insert.
+class CanonicalIndex:
+    def __init__(self):
+        self.ids: Dict[type, Dict[str, int]] = {}
+        # id -> [key, number of saves holding it], per class
+        self.pending: Dict[type, Dict[int, list]] = {}
+        self._lock = Lock()
+
+    def load(self, model_class) -> Dict[str, int]:
+        column = fields(model_class)[0].name
+        table = model_class.__sqlmodel__.__tablename__
+        with pooled_connection() as duck:
+            rows = duck.execute(
+                f'SELECT "{column}", id FROM {table} ORDER BY id'
+            ).fetchall()
+        known = {}
+        # Duplicates saved before canonicalization resolve to the oldest node
+        for value, id in rows:
+            known.setdefault(normalize(value), id)
+        return known
+
+    # Maps each value to its canonical id, allocating ids for names not seen
+    # before. Returns the id per value, the (value, id) nodes that are new, and
+    # the pending (value, id) nodes, new ones included, that the caller now
+    # holds: it inserts them and hands them to settle once its write is done.
+    def canonicalize(
+        self, model_class, values: List
+    ) -> Tuple[List[int], List[Tuple[Any, int]], List[Tuple[Any, int]]]:
+        with self._lock:
+            if model_class not in self.ids:
+                self.ids[model_class] = self.load(model_class)
+            known = self.ids[model_class]
+            pending = self.pending.setdefault(model_class, {})
+            keys = [normalize(value) for value in values]
+            new, held = {}, {}
+            for key, value in zip(keys, values):
+                if key not in known:
+                    new.setdefault(key, value)
+                elif known[key] in pending:
+                    held.setdefault(key, value)
+            new_ids = allocate_ids(len(new))
+            known.update(zip(new, new_ids))
+            for key, id in zip(new, new_ids):
+                pending[id] = [key, 1]
+            for key in held:
+                pending[known[key]][1] += 1
+            held.update(new)
+            ids = [known[key] for key in keys]
+            held = [(value, known[key]) for key, value in held.items()]
+            return ids, list(zip(new.values(), new_ids)), held
+
+    # Releases the nodes a canonicalize call returned as held. Once a holder has
+    # saved them they are in the table; if the last holder failed, their names
+    # are dropped from the map and get new ids next time.
+    def settle(self, model_class, held: List[Tuple[Any, int]], saved: bool):
+        with self._lock:
+            known = self.ids.get(model_class, {})
+            pending = self.pending.get(model_class, {})
+            for _, id in held:
+                entry = pending.get(id)
+                if entry is None:
+                    continue
+                entry[1] -= 1
+                if saved or entry[1] == 0:
+                    del pending[id]
+                if not saved and entry[1] == 0 and known.get(entry[0]) == id:
+                    del known[entry[0]]
+
+    # Records ids saved outside canonicalize, if the class's map is loaded
+    def remember(self, model_class, values: List, ids: List[int]):
+        with self._lock:
+            known = self.ids.get(model_class)
+            if known is not None:
+                for value, id in zip(values, ids):
+                    known.setdefault(normalize(value), id)
+
+    # After a failed save the map may hold ids that never reached the table
+    def forget(self, model_class):
+        with self._lock:
+            self.ids.pop(model_class, None)
+            self.pending.pop(model_class, None)
+
+
+CANONICAL_IDS = CanonicalIndex()
@@ -1,26 +1,150 @@
-from typing import List
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from threading import Lock, RLock
+from typing import Callable, Iterator, List, Tuple
 
 from fquery.sqlmodel import GLOBAL_ID_SEQ
-from sqlalchemy import create_engine, func
+from pandas import DataFrame
+from sqlalchemy import create_engine, text
 from sqlmodel import Session
 
-DATABASE_URL = "duckdb:///kg.db"
+DATABASE_PATH = "kg.db"
+DATABASE_URL = f"duckdb:///{DATABASE_PATH}"
+# Number of global ids reserved per round trip to the sequence
+ID_BLOCK_SIZE = 4096
+# Pooled connections shared by readers and the writer
+POOL_SIZE = 8
 
-engine = create_engine(DATABASE_URL, echo=True)
 
+def create_pool(pool_size=POOL_SIZE):
+    return create_engine(DATABASE_URL, echo=True, pool_size=pool_size, max_overflow=0)
 
-def allocate_ids(n) -> List[int] | None:
-    ids = None
-    with engine.connect() as conn:
-        ids = [conn.execute(func.next_value(GLOBAL_ID_SEQ)).scalar() for _ in range(n)]
-    return ids
 
+engine = create_pool()
+# DuckDB takes one writer at a time, so writes are serialized here while reads
+# run concurrently on their own pooled connections. Reentrant, so a writer can
+# open a nested write session (e.g. to register a missing type).
+WRITE_LOCK = RLock()
 
-class Database:
-    _instance = None
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(Database, cls).__new__(cls)
-            cls._instance.db = Session(engine)
-        return cls._instance
+# Replaces the pool; code that goes through the helpers below picks it up
+def configure_pool(pool_size: int):
+    global engine
+    old, engine = engine, create_pool(pool_size)
+    old.dispose()
+
+
+# A session of its own for the calling task or thread, returned to the pool on
+# exit. Write sessions hold WRITE_LOCK throughout.
+@contextmanager
+def get_session(write=False) -> Iterator[Session]:
+    with WRITE_LOCK if write else nullcontext():
+        with Session(engine) as session:
+            yield session
+
+
+# Runs fn on a worker thread holding WRITE_LOCK, so async callers don't block
+# the event loop on database I/O and DuckDB still sees a single writer
+async def run_writer(fn: Callable, *args):
+    def locked():
+        with WRITE_LOCK:
+            return fn(*args)
+
+    return await asyncio.to_thread(locked)
+
+
+async def run_reader(fn: Callable, *args):
+    return await asyncio.to_thread(fn, *args)
+
+
+# The raw DuckDB connection behind a pooled connection
+@contextmanager
+def pooled_connection():
+    conn = engine.raw_connection()
+    try:
+        yield conn.driver_connection
+    finally:
+        conn.close()
+
+
+def reserve_ids(n) -> List[int]:
+    # One statement for the whole range instead of one nextval() per id. It
+    # must commit: a rolled back nextval() leaves the sequence where it was, and
+    # the next process would be handed the same ids.
+    statement = text(
+        f"SELECT nextval('{GLOBAL_ID_SEQ.name}') AS id FROM range(:n) ORDER BY id"
+    )
+    with engine.begin() as conn:
+        return list(conn.execute(statement, {"n": n}).scalars())
+
+
+# Hands out global ids from an in-process block of reserved ids. The block is
+# topped up in a background thread once it falls below half of block_size, so
+# most allocations never touch the database.
+class IdAllocator:
+    def __init__(self, block_size=ID_BLOCK_SIZE):
+        self.block_size = block_size
+        self._block: List[int] = []
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._refill = None
+
+    def allocate(self, n) -> List[int]:
+        with self._lock:
+            refill, self._refill = self._refill, None
+            if refill is not None:
+                # A failed refill is dropped; the shortfall is reserved below
+                try:
+                    self._block.extend(refill.result())
+                except Exception:
+                    pass
+            if len(self._block) < n:
+                missing = n - len(self._block)
+                self._block.extend(reserve_ids(max(missing, self.block_size)))
+            ids, self._block = self._block[:n], self._block[n:]
+            if len(self._block) < self.block_size // 2:
+                self._refill = self._executor.submit(reserve_ids, self.block_size)
+            return ids
+
+
+ID_ALLOCATOR = IdAllocator()
+
+
+def allocate_ids(n) -> List[int]:
+    return ID_ALLOCATOR.allocate(n)
+
+
+# A DuckDB write transaction on a pooled connection, for the set-based
+# statements that bypass the ORM
+@contextmanager
+def raw_transaction():
+    with WRITE_LOCK, pooled_connection() as duck:
+        duck.begin()
+        try:
+            yield duck
+            duck.commit()
+        except BaseException:
+            duck.rollback()
+            raise
+
+
+# Inserts the rows of df through DuckDB's native DataFrame scan. clause is
+# appended to the INSERT (ON CONFLICT, RETURNING) and its rows are returned.
+def insert_frame(duck, table: str, df: DataFrame, clause: str = "") -> List[tuple]:
+    columns = ", ".join(f'"{c}"' for c in df.columns)
+    duck.register("_batch", df)
+    try:
+        return duck.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM _batch {clause}"
+        ).fetchall()
+    finally:
+        duck.unregister("_batch")
+
+
+# Appends (table, DataFrame) pairs, or (table, DataFrame, clause) triples, in
+# one transaction, bypassing the ORM unit of work
+def append_frames(frames: List[Tuple]) -> None:
+    with raw_transaction() as duck:
+        for table, df, *clause in frames:
+            insert_frame(duck, table, df, *clause)
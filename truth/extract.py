@@ -0,0 +1,229 @@
+# Fans prompts out over LLM endpoints with bounded concurrency and per-endpoint
+# rate limits. Completions flow through a bounded queue into a single save
+# stage, so a slow writer pushes back on generation instead of buffering
+# without limit.
+
+import asyncio
+import csv
+import io
+import re
+import time
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, List
+
+from langchain_core.language_models import BaseLLM
+from llm_cache import PromptCache
+
+
+def extract_code(text):
+    pattern = r"```(\w+)\n(.*?)```"
+    match = re.search(pattern, text, re.DOTALL)
+    if match:
+        return match.group(2).strip()
+    else:
+        return None
+
+
+def parse_csv(text) -> List[List[str]]:
+    if text.startswith("```"):
+        csv_string = extract_code(text)
+    else:
+        csv_string = text
+    return list(csv.reader(io.StringIO(csv_string)))
+
+
+# Rows per save call when streaming CSV out of a generation
+STREAM_BATCH_ROWS = 100
+
+
+async def stream_lines(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    buffer = ""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line
+    yield buffer
+
+
+# Parses CSV rows out of a stream of text chunks as soon as each line is
+# complete. A leading ``` fence is stripped and lines after the closing fence
+# are ignored, like extract_code does for whole completions. The stream is
+# still read to the end, so the endpoint sees the generation finish and caches
+# it. Rows are assumed to be one per line.
+async def stream_csv_rows(chunks: AsyncIterator[str]) -> AsyncIterator[List[str]]:
+    fenced = None
+    closed = False
+    async with aclosing(stream_lines(chunks)) as lines:
+        async for line in lines:
+            if closed:
+                continue
+            if fenced is None:
+                if not line.strip():
+                    continue
+                fenced = line.startswith("```")
+                if fenced:
+                    continue
+            elif fenced and line.startswith("```"):
+                closed = True
+                continue
+            if line.strip():
+                yield next(csv.reader([line]))
+
+
+# Token bucket: at most rate requests per second, in bursts of up to burst
+class RateLimiter:
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Endpoint:
+    def __init__(
+        self,
+        llm: BaseLLM,
+        concurrency=4,
+        rate: float | None = None,
+        cache: PromptCache | None = None,
+    ):
+        self.llm = llm
+        self.cache = cache
+        self.params = llm._identifying_params
+        self.model = self.params.get("model", type(llm).__name__)
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiter = None if rate is None else RateLimiter(rate, concurrency)
+
+    async def generate(self, prompt: str) -> str:
+        # Cache hits skip the concurrency and rate limits entirely
+        if self.cache is not None:
+            text = self.cache.get(self.model, prompt, self.params)
+            if text is not None:
+                return text
+        self.in_flight += 1
+        try:
+            async with self._semaphore:
+                if self._limiter is not None:
+                    await self._limiter.acquire()
+                result = await self.llm.agenerate([prompt])
+                text = result.generations[0][0].text
+        finally:
+            self.in_flight -= 1
+        if self.cache is not None:
+            self.cache.put(self.model, prompt, self.params, text)
+        return text
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        if self.cache is not None:
+            text = self.cache.get(self.model, prompt, self.params)
+            if text is not None:
+                yield text
+                return
+        chunks = []
+        self.in_flight += 1
+        try:
+            async with self._semaphore:
+                if self._limiter is not None:
+                    await self._limiter.acquire()
+                async for chunk in self.llm.astream(prompt):
+                    chunks.append(chunk)
+                    yield chunk
+        finally:
+            self.in_flight -= 1
+        # Only reached when the whole generation was consumed
+        if self.cache is not None:
+            self.cache.put(self.model, prompt, self.params, "".join(chunks))
+
+
+@dataclass
+class Extraction:
+    prompt: str
+    # Parses a completion and saves it, e.g. returning the number of rows saved
+    save: Callable[[str], Awaitable[Any]]
+
+
+class ExtractionPool:
+    def __init__(self, endpoints: List[Endpoint], queue_size=16):
+        self.endpoints = endpoints
+        self.queue_size = queue_size
+
+    def endpoint(self) -> Endpoint:
+        return min(self.endpoints, key=lambda e: e.in_flight / e.concurrency)
+
+    async def generate(self, prompt: str) -> str:
+        return await self.endpoint().generate(prompt)
+
+    # Streams one generation and hands its CSV rows to save in micro-batches
+    # while the model is still generating. Returns the sum of what save returned.
+    async def stream(
+        self,
+        prompt: str,
+        save: Callable[[List[List[str]]], Awaitable[int]],
+        batch_size=STREAM_BATCH_ROWS,
+    ) -> int:
+        total = 0
+        batch = []
+        async with (
+            aclosing(self.endpoint().stream(prompt)) as chunks,
+            aclosing(stream_csv_rows(chunks)) as rows,
+        ):
+            async for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    total += await save(batch)
+                    batch = []
+        if batch:
+            total += await save(batch)
+        return total
+
+    # Returns what each extraction's save returned, in input order
+    async def run(self, extractions: Iterable[Extraction]) -> List[Any]:
+        pending = iter(enumerate(extractions))
+        completions = asyncio.Queue(maxsize=self.queue_size)
+        results = {}
+
+        async def generate():
+            for i, extraction in pending:
+                text = await self.generate(extraction.prompt)
+                await completions.put((i, extraction, text))
+
+        async def save():
+            while (item := await completions.get()) is not None:
+                i, extraction, text = item
+                results[i] = await extraction.save(text)
+
+        workers = sum(e.concurrency for e in self.endpoints)
+        saver = asyncio.create_task(save())
+        generators = asyncio.gather(*(generate() for _ in range(workers)))
+        try:
+            # The saver only finishes early when it fails; don't leave the
+            # generators blocked on a full queue
+            await asyncio.wait([saver, generators], return_when=asyncio.FIRST_COMPLETED)
+            if saver.done():
+                saver.result()
+            await generators
+            await completions.put(None)
+            await saver
+        finally:
+            saver.cancel()
+            generators.cancel()
+            await asyncio.gather(saver, generators, return_exceptions=True)
+        return [results[i] for i in sorted(results)]
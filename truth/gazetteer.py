@@ -0,0 +1,264 @@
+# Links the world.db gazetteer built by import_cities.py into the knowledge
+# graph: countries become Country nodes, cities become City nodes with an
+# Address(lat, long) each, joined by CapitalRelation and AddressCityRelation
+# edges. world.db is attached to kg.db and every step is one set-based
+# statement. gazetteer_links records which node each world row became, so a
+# rerun only adds what is new. world.db states have no @graph class and are
+# not linked.
+
+import asyncio
+from argparse import ArgumentParser
+from dataclasses import fields
+from typing import Dict, List, Tuple
+
+from canonical import CANONICAL_IDS, normalize_sql
+from database import WRITE_LOCK, engine, insert_frame, pooled_connection, run_writer
+from fquery.sqlmodel import GLOBAL_ID_SEQ
+from kg import (
+    Relation,
+    TypeRelation,
+    index_edges,
+    load_schema_registry,
+    table_name,
+    type_relation_frame,
+)
+from schema.places import Address, AddressCityRelation, CapitalRelation, City, Country
+from sqlmodel import SQLModel
+
+WORLD_PATH = "world.db"
+LINKS_TABLE = "gazetteer_links"
+NEXT_ID = f"nextval('{GLOBAL_ID_SEQ.name}')"
+
+
+def create_links_table(duck):
+    duck.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {LINKS_TABLE} (
+            source VARCHAR,
+            world_id BIGINT,
+            kg_id BIGINT,
+            PRIMARY KEY (source, world_id)
+        )
+        """
+    )
+
+
+def insert_types(duck, model_class, ids: List[int]) -> int:
+    if ids:
+        insert_frame(
+            duck, table_name(TypeRelation), type_relation_frame(model_class, ids)
+        )
+    return len(ids)
+
+
+# Links (world_id, name) rows to model_class nodes. A world name that is unique
+# in the source reuses a node with the same normalized name, e.g. a country
+# the LLM already extracted; every other row gets a node of its own.
+def link_named(duck, source: str, model_class, world_rows: str) -> int:
+    table = table_name(model_class)
+    name = fields(model_class)[0].name
+    duck.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE _world AS
+        SELECT world_id, name, {normalize_sql("name")} AS key,
+            count(*) OVER (PARTITION BY {normalize_sql("name")}) = 1 AS unique_key
+        FROM ({world_rows})
+        """
+    )
+    duck.execute(
+        f"""
+        INSERT INTO {LINKS_TABLE} (source, world_id, kg_id)
+        SELECT ?, w.world_id, coalesce(k.id, {NEXT_ID})
+        FROM _world w
+        LEFT JOIN (
+            SELECT {normalize_sql(f'"{name}"')} AS key, min(id) AS id
+            FROM {table}
+            GROUP BY ALL
+        ) k ON k.key = w.key AND w.unique_key
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {LINKS_TABLE} l
+            WHERE l.source = ? AND l.world_id = w.world_id
+        )
+        """,
+        [source, source],
+    )
+    ids = duck.execute(
+        f"""
+        INSERT INTO {table} (id, "{name}")
+        SELECT l.kg_id, w.name
+        FROM {LINKS_TABLE} l JOIN _world w ON l.world_id = w.world_id
+        WHERE l.source = ? AND l.kg_id NOT IN (SELECT id FROM {table})
+        RETURNING id
+        """,
+        [source],
+    ).fetchall()
+    return insert_types(duck, model_class, [id for id, in ids])
+
+
+# One Address node per city with coordinates
+def link_addresses(duck) -> int:
+    duck.execute(
+        f"""
+        INSERT INTO {LINKS_TABLE} (source, world_id, kg_id)
+        SELECT 'addresses', c.id, {NEXT_ID}
+        FROM world.cities c
+        WHERE c.latitude IS NOT NULL AND c.longitude IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM {LINKS_TABLE} l
+                WHERE l.source = 'addresses' AND l.world_id = c.id
+            )
+        """
+    )
+    table = table_name(Address)
+    ids = duck.execute(
+        f"""
+        INSERT INTO {table} (id, lat, long)
+        SELECT l.kg_id, c.latitude, c.longitude
+        FROM {LINKS_TABLE} l JOIN world.cities c ON l.world_id = c.id
+        WHERE l.source = 'addresses' AND l.kg_id NOT IN (SELECT id FROM {table})
+        RETURNING id
+        """
+    ).fetchall()
+    return insert_types(duck, Address, [id for id, in ids])
+
+
+# Inserts the (src, dst) pairs selected by pairs that are not saved yet
+def link_edges(duck, relation_class, pairs: str, viewpoint) -> Tuple[List, List]:
+    rtype = relation_class.TYPE.id
+    defaults = Relation(src=0, rtype=rtype, dst=0, viewpoint=viewpoint)
+    edges = duck.execute(
+        f"""
+        INSERT INTO {table_name(Relation)}
+            (src, rtype, dst, start, "end", probability, viewpoint)
+        SELECT DISTINCT p.src, ?, p.dst, ?, ?, ?, ?
+        FROM ({pairs}) p
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {table_name(Relation)} r
+            WHERE r.src = p.src AND r.rtype = ? AND r.dst = p.dst
+                AND r.viewpoint = ?
+        )
+        RETURNING src, dst
+        """,
+        [
+            rtype,
+            defaults.start,
+            str(defaults.end),
+            defaults.probability,
+            viewpoint,
+            rtype,
+            viewpoint,
+        ],
+    ).fetchall()
+    return [src for src, _ in edges], [dst for _, dst in edges]
+
+
+ADDRESS_CITY_PAIRS = f"""
+    SELECT a.kg_id AS src, c.kg_id AS dst
+    FROM {LINKS_TABLE} a JOIN {LINKS_TABLE} c ON a.world_id = c.world_id
+    WHERE a.source = 'addresses' AND c.source = 'cities'
+"""
+
+# A country's capital is a name; it is matched against the country's own
+# cities, taking the lowest id when the name repeats
+CAPITALS = f"""
+    SELECT w.id AS country_id, cap.id AS city_id, cap.key
+    FROM world.countries w
+    JOIN (
+        SELECT country_id, {normalize_sql("name")} AS key, min(id) AS id
+        FROM world.cities
+        GROUP BY ALL
+    ) cap ON cap.country_id = w.id AND cap.key = {normalize_sql("w.capital")}
+"""
+
+CAPITAL_PAIRS = f"""
+    SELECT co.kg_id AS src, ci.kg_id AS dst
+    FROM ({CAPITALS}) cap
+    JOIN {LINKS_TABLE} co ON co.source = 'countries' AND co.world_id = cap.country_id
+    JOIN {LINKS_TABLE} ci ON ci.source = 'cities' AND ci.world_id = cap.city_id
+"""
+
+
+# link_named only reuses cities whose name is unique in world.db, which leaves
+# out capitals like Paris. A linked country whose CapitalRelation (in any
+# viewpoint) already points at a City named like its capital has that City
+# linked to the capital's world row, so the capital is not created twice.
+def link_capitals(duck):
+    cities = table_name(City)
+    name = fields(City)[0].name
+    duck.execute(
+        f"""
+        INSERT INTO {LINKS_TABLE} (source, world_id, kg_id)
+        SELECT 'cities', cap.city_id, min(c.id)
+        FROM ({CAPITALS}) cap
+        JOIN {LINKS_TABLE} co ON co.source = 'countries' AND co.world_id = cap.country_id
+        JOIN {table_name(Relation)} r ON r.src = co.kg_id AND r.rtype = ?
+        JOIN {cities} c ON c.id = r.dst AND {normalize_sql(f'c."{name}"')} = cap.key
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {LINKS_TABLE} l
+            WHERE l.source = 'cities' AND l.world_id = cap.city_id
+        )
+        GROUP BY cap.city_id
+        """,
+        [CapitalRelation.TYPE.id],
+    )
+
+
+def link_world(world_path: str, viewpoint=0) -> Tuple[Dict[str, int], Dict]:
+    with WRITE_LOCK, pooled_connection() as duck:
+        create_links_table(duck)
+        duck.execute(f"ATTACH '{world_path}' AS world (READ_ONLY)")
+        try:
+            duck.begin()
+            try:
+                counts = {
+                    "countries": link_named(
+                        duck,
+                        "countries",
+                        Country,
+                        "SELECT id AS world_id, name FROM world.countries",
+                    )
+                }
+                link_capitals(duck)
+                counts["cities"] = link_named(
+                    duck,
+                    "cities",
+                    City,
+                    "SELECT id AS world_id, name FROM world.cities",
+                )
+                counts["addresses"] = link_addresses(duck)
+                edges = {
+                    AddressCityRelation: link_edges(
+                        duck, AddressCityRelation, ADDRESS_CITY_PAIRS, viewpoint
+                    ),
+                    CapitalRelation: link_edges(
+                        duck, CapitalRelation, CAPITAL_PAIRS, viewpoint
+                    ),
+                }
+                duck.commit()
+            except BaseException:
+                duck.rollback()
+                raise
+        finally:
+            duck.execute("DETACH world")
+    # The node tables changed underneath the canonical-id maps
+    CANONICAL_IDS.forget(Country)
+    CANONICAL_IDS.forget(City)
+    return counts, edges
+
+
+# Returns the number of nodes and edges added per kind
+async def link_gazetteer(world_path=WORLD_PATH, viewpoint=0) -> Dict[str, int]:
+    counts, edges = await run_writer(link_world, world_path, viewpoint)
+    for relation_class, (src, dst) in edges.items():
+        index_edges(src, relation_class.TYPE.id, dst, viewpoint=viewpoint)
+        counts[relation_class.__name__] = len(src)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--world", type=str, default=WORLD_PATH)
+    args = parser.parse_args()
+    SQLModel.metadata.create_all(engine)
+    load_schema_registry()
+    print(asyncio.run(link_gazetteer(args.world)))
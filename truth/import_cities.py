@@ -1,88 +1,190 @@
 # https://github.com/dr5hn/countries-states-cities-database
 # imports world.sqlite3 to world.db (duckdb)
+#
+# Two engines: "pandas" streams chunks through DataFrames, "duckdb" attaches
+# the SQLite file with DuckDB's sqlite extension and migrates each table with
+# one INSERT ... SELECT, so no rows pass through Python.
 
+import hashlib
+import json
+import os
 import re
 import sqlite3
+import time
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from graphlib import TopologicalSorter
+from threading import Lock
+from typing import Dict, List, NamedTuple
 
 import duckdb
 import inflect
+import numpy as np
 import pandas as pd
 
 p = inflect.engine()
 
+# Tables to migrate, in global id order; load order comes from their foreign keys
+TABLES = ["regions", "subregions", "countries", "states", "cities"]
+FK_CACHE_SUFFIX = ".fks.json"
+# Rows read from SQLite and inserted into DuckDB at a time
+CHUNK_ROWS = 50_000
+WORKERS = 4
 
-def migrate_with_global_sequence(
-    sqlite_path="your_sqlite_db.db", duck_path="your_duckdb.db"
-):
-    # Connect to databases
-    sqlite_conn = sqlite3.connect(sqlite_path)
-    duck_conn = duckdb.connect(duck_path)
 
-    duck_conn.execute("CREATE SEQUENCE global_sequence")
+# Global ids of a table are base + the position of the old id among the
+# table's sorted ids, so remapping is a searchsorted instead of a dict lookup
+class IdMap(NamedTuple):
+    ids: np.ndarray
+    base: int
 
-    # Create a sequence to track global IDs
-    current_id = 1
+    def remap(self, values: pd.Series) -> pd.Series:
+        old = pd.to_numeric(values, errors="coerce").to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+        pos = np.searchsorted(self.ids, old)
+        found = pos < len(self.ids)
+        found[found] = self.ids[pos[found]] == old[found]
+        new = pd.array(self.base + pos, dtype="Int64")
+        # Unknown references become NULL, as with Series.map over a dict
+        new[~found] = pd.NA
+        return pd.Series(new, index=values.index)
 
-    # Tables to migrate
-    tables = ["regions", "subregions", "countries", "states", "cities"]
 
-    # Dictionary to store old_id -> new_id mappings for each table
-    id_mappings = {table: {} for table in tables}
+def table_columns(sqlite_conn, table) -> List[str]:
+    return [row[1] for row in sqlite_conn.execute(f"PRAGMA table_info({table})")]
 
-    # First pass: Read data and create mappings
-    for table in tables:
-        # Read data from SQLite using pandas
-        df = pd.read_sql_query(f"SELECT * FROM {table}", sqlite_conn)
 
-        # Create mapping for this table
-        for old_id in df["id"]:
-            id_mappings[table][old_id] = current_id
-            current_id += 1
+# Declared foreign keys first; undeclared *_id columns fall back to guessing
+# the table from the pluralized column name
+def infer_foreign_keys(sqlite_conn, table) -> Dict[str, str]:
+    refs = {
+        row[3]: row[2]
+        for row in sqlite_conn.execute(f"PRAGMA foreign_key_list({table})")
+    }
+    for col in table_columns(sqlite_conn, table):
+        if col.endswith("_id") and col not in refs:
+            refs[col] = p.plural(col[:-3])
+    return {col: ref_table for col, ref_table in refs.items() if ref_table in TABLES}
 
-    # Second pass: Create new tables and insert data with updated IDs
-    for table in tables:
-        # Read schema from SQLite
-        cursor = sqlite_conn.cursor()
-        cursor.execute(
-            f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table}'"
-        )
-        create_stmt = cursor.fetchone()[0]
 
-        # Create table in DuckDB
-        create_stmt = create_stmt.replace(
-            "AUTOINCREMENT", "DEFAULT nextval('global_sequence')"
-        )
-        create_stmt = create_stmt.replace("MEDIUMINT", "INTEGER")
-        print(create_stmt)
-        duck_conn.execute(create_stmt)
+def schema_fingerprint(sqlite_conn) -> str:
+    schema = sqlite_conn.execute(
+        "SELECT type, name, sql FROM sqlite_master ORDER BY type, name"
+    ).fetchall()
+    return hashlib.sha256(json.dumps([schema, TABLES]).encode()).hexdigest()
 
-        # Read data from SQLite using pandas
-        df = pd.read_sql_query(f"SELECT * FROM {table}", sqlite_conn)
 
-        # Update IDs in the dataframe
-        df["id"] = df["id"].map(id_mappings[table])
+# The resolved {table: {column: referenced table}} graph, cached next to the
+# SQLite file and reused for as long as its schema is unchanged
+def foreign_key_graph(sqlite_conn, sqlite_path) -> Dict[str, Dict[str, str]]:
+    cache_path = sqlite_path + FK_CACHE_SUFFIX
+    fingerprint = schema_fingerprint(sqlite_conn)
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached["fingerprint"] == fingerprint:
+            return cached["foreign_keys"]
+    except (OSError, ValueError, KeyError):
+        pass
+    graph = {table: infer_foreign_keys(sqlite_conn, table) for table in TABLES}
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"fingerprint": fingerprint, "foreign_keys": graph}, f)
+    os.replace(tmp_path, cache_path)
+    return graph
 
-        # update timestamps. sqlite -> duckdb timestamp errors out
-        df["created_at"] = pd.Timestamp.now()
-        df["updated_at"] = pd.Timestamp.now()
 
-        # Update foreign key references if they exist
-        for col in df.columns:
-            if col.endswith("_id"):
-                ref_table = p.plural(col[:-3])
-                if ref_table in tables:
-                    df[col] = df[col].map(id_mappings[ref_table])
+# Parents before children; a table referencing itself doesn't wait on itself
+def load_order(graph: Dict[str, Dict[str, str]]) -> TopologicalSorter:
+    return TopologicalSorter(
+        {
+            table: {ref for ref in refs.values() if ref != table}
+            for table, refs in graph.items()
+        }
+    )
 
-        # Insert data into DuckDB
-        duck_conn.execute(
-            f"""
-            INSERT INTO {table}
-            SELECT * FROM df
-        """
+
+def read_id_maps(sqlite_conn) -> Dict[str, IdMap]:
+    # Only the id column is read here; the rows are read once, in migrate_table
+    id_maps = {}
+    current_id = 1
+    for table in TABLES:
+        ids = pd.read_sql_query(f"SELECT id FROM {table} ORDER BY id", sqlite_conn)
+        ids = ids["id"].to_numpy(dtype=np.int64)
+        id_maps[table] = IdMap(ids, current_id)
+        current_id += len(ids)
+    return id_maps
+
+
+def create_table(sqlite_conn, duck_conn, table):
+    # Read schema from SQLite
+    cursor = sqlite_conn.cursor()
+    cursor.execute(
+        f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table}'"
+    )
+    create_stmt = cursor.fetchone()[0]
+
+    # Create table in DuckDB
+    create_stmt = create_stmt.replace(
+        "AUTOINCREMENT", "DEFAULT nextval('global_sequence')"
+    )
+    create_stmt = create_stmt.replace("MEDIUMINT", "INTEGER")
+    print(create_stmt)
+    duck_conn.execute(create_stmt)
+
+
+class Progress:
+    def __init__(self, totals: Dict[str, int]):
+        self.totals = totals
+        self.done = dict.fromkeys(totals, 0)
+        self.start = time.perf_counter()
+        self._lock = Lock()
+
+    def update(self, table, rows):
+        with self._lock:
+            self.done[table] += rows
+            done = sum(self.done.values())
+            rate = done / max(time.perf_counter() - self.start, 1e-9)
+            print(
+                f"{table}: {self.done[table]}/{self.totals[table]} rows, "
+                f"total {done}/{sum(self.totals.values())} at {rate:,.0f} rows/sec"
+            )
+
+
+def migrate_table(sqlite_path, duck_conn, table, id_maps, refs, progress, now):
+    # sqlite3 and duckdb connections are per thread
+    sqlite_conn = sqlite3.connect(sqlite_path)
+    duck = duck_conn.cursor()
+    try:
+        chunks = pd.read_sql_query(
+            f"SELECT * FROM {table} ORDER BY id", sqlite_conn, chunksize=CHUNK_ROWS
         )
+        rows = 0
+        for df in chunks:
+            # Update IDs in the dataframe
+            df["id"] = id_maps[table].remap(df["id"])
+
+            # update timestamps. sqlite -> duckdb timestamp errors out
+            df["created_at"] = now
+            df["updated_at"] = now
 
-        print(f"Migrated {table} with {len(df)} rows")
+            # Update foreign key references if they exist
+            for col, ref_table in refs.items():
+                df[col] = id_maps[ref_table].remap(df[col])
 
+            duck.register("chunk", df)
+            duck.execute(f"INSERT INTO {table} SELECT * FROM chunk")
+            duck.unregister("chunk")
+            rows += len(df)
+            progress.update(table, len(df))
+        return rows
+    finally:
+        duck.close()
+        sqlite_conn.close()
+
+
+def create_indexes(sqlite_conn, duck_conn):
     # Run the query to get index definitions
     cursor = sqlite_conn.cursor()
     cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='index'")
@@ -104,11 +206,163 @@ def migrate_with_global_sequence(
             f"CREATE INDEX {index_name} ON {table_name} ({', '.join(column_names)})"
         )
 
+
+def migrate_with_global_sequence(
+    sqlite_path="your_sqlite_db.db", duck_path="your_duckdb.db", workers=WORKERS
+):
+    # Connect to databases
+    sqlite_conn = sqlite3.connect(sqlite_path)
+    duck_conn = duckdb.connect(duck_path)
+
+    # Global ids for every table, from the id columns alone
+    id_maps = read_id_maps(sqlite_conn)
+    next_id = sum(len(id_map.ids) for id_map in id_maps.values()) + 1
+
+    # The sequence continues after the migrated ids, so later inserts that take
+    # their id from it don't collide
+    duck_conn.execute(f"CREATE SEQUENCE global_sequence START WITH {next_id}")
+    graph = foreign_key_graph(sqlite_conn, sqlite_path)
+    for table in load_order(graph).static_order():
+        create_table(sqlite_conn, duck_conn, table)
+
+    progress = Progress({table: len(id_maps[table].ids) for table in TABLES})
+    now = pd.Timestamp.now()
+    # A table starts once every table it references is loaded, since DuckDB
+    # enforces declared foreign keys; independent branches load in parallel
+    order = load_order(graph)
+    order.prepare()
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while order.is_active():
+            for table in order.get_ready():
+                future = pool.submit(
+                    migrate_table,
+                    sqlite_path,
+                    duck_conn,
+                    table,
+                    id_maps,
+                    graph[table],
+                    progress,
+                    now,
+                )
+                running[future] = table
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                table = running.pop(future)
+                print(f"Migrated {table} with {future.result()} rows")
+                order.done(table)
+
+    elapsed = time.perf_counter() - progress.start
+    total = sum(progress.done.values())
+    print(f"Migrated {total} rows in {elapsed:.1f}s, {total / elapsed:,.0f} rows/sec")
+
+    create_indexes(sqlite_conn, duck_conn)
+
     # Commit changes and close connections
     duck_conn.commit()
     sqlite_conn.close()
     duck_conn.close()
 
 
+def attach_sqlite(duck_conn, sqlite_path):
+    duck_conn.execute("INSTALL sqlite")
+    duck_conn.execute("LOAD sqlite")
+    duck_conn.execute(f"ATTACH '{sqlite_path}' AS world (TYPE SQLITE, READ_ONLY)")
+
+
+# Same ids and rows as migrate_with_global_sequence, computed by DuckDB: each
+# table gets an (old_id, new_id) mapping table numbered from its base offset,
+# and foreign keys are rewritten by joining against the parent's mapping
+def migrate_with_sqlite_scanner(
+    sqlite_path="your_sqlite_db.db", duck_path="your_duckdb.db"
+):
+    # The SQLite connection is only used for the schema
+    sqlite_conn = sqlite3.connect(sqlite_path)
+    duck_conn = duckdb.connect(duck_path)
+    attach_sqlite(duck_conn, sqlite_path)
+    start = time.perf_counter()
+
+    counts = {
+        table: duck_conn.execute(f"SELECT count(*) FROM world.{table}").fetchone()[0]
+        for table in TABLES
+    }
+    base = 1
+    for table in TABLES:
+        duck_conn.execute(
+            f"""
+            CREATE TEMP TABLE ids_{table} AS
+            SELECT id AS old_id, {base} + row_number() OVER (ORDER BY id) - 1 AS new_id
+            FROM world.{table}
+            """
+        )
+        base += counts[table]
+
+    # The sequence continues after the migrated ids
+    duck_conn.execute(f"CREATE SEQUENCE global_sequence START WITH {base}")
+    graph = foreign_key_graph(sqlite_conn, sqlite_path)
+    tables = list(load_order(graph).static_order())
+    for table in tables:
+        create_table(sqlite_conn, duck_conn, table)
+
+    duck_conn.begin()
+    for table in tables:
+        columns = table_columns(sqlite_conn, table)
+        refs = graph[table]
+        select = []
+        joins = [f"JOIN ids_{table} AS ids ON ids.old_id = t.id"]
+        for col in columns:
+            if col == "id":
+                select.append("ids.new_id")
+            elif col in ("created_at", "updated_at"):
+                # sqlite -> duckdb timestamp errors out
+                select.append("localtimestamp")
+            elif col in refs:
+                # Unknown references become NULL, as in the pandas engine
+                select.append(f'"ref_{col}".new_id')
+                joins.append(
+                    f'LEFT JOIN ids_{refs[col]} AS "ref_{col}" '
+                    f'ON "ref_{col}".old_id = t."{col}"'
+                )
+            else:
+                select.append(f't."{col}"')
+        names = ", ".join(f'"{col}"' for col in columns)
+        table_start = time.perf_counter()
+        duck_conn.execute(
+            f"""
+            INSERT INTO {table} ({names})
+            SELECT {", ".join(select)}
+            FROM world.{table} AS t {" ".join(joins)}
+            ORDER BY t.id
+            """
+        )
+        elapsed = time.perf_counter() - table_start
+        print(
+            f"Migrated {table} with {counts[table]} rows, "
+            f"{counts[table] / max(elapsed, 1e-9):,.0f} rows/sec"
+        )
+    duck_conn.commit()
+
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    print(f"Migrated {total} rows in {elapsed:.1f}s, {total / elapsed:,.0f} rows/sec")
+
+    create_indexes(sqlite_conn, duck_conn)
+
+    duck_conn.commit()
+    sqlite_conn.close()
+    duck_conn.close()
+
+
+ENGINES = {
+    "pandas": migrate_with_global_sequence,
+    "duckdb": migrate_with_sqlite_scanner,
+}
+
+
 if __name__ == "__main__":
-    migrate_with_global_sequence("world.sqlite3", "world.db")
+    parser = ArgumentParser()
+    parser.add_argument("--engine", choices=ENGINES, default="pandas")
+    parser.add_argument("--sqlite", type=str, default="world.sqlite3")
+    parser.add_argument("--duckdb", type=str, default="world.db")
+    args = parser.parse_args()
+    ENGINES[args.engine](args.sqlite, args.duckdb)
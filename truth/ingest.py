@@ -0,0 +1,107 @@
+# Single-writer ingest queue with group commit. Save calls enqueue their frames
+# and await a future; one writer task coalesces whatever is queued within
+# GROUP_COMMIT_MS, up to GROUP_COMMIT_ROWS rows, into one transaction with one
+# INSERT per table, instead of a commit per save call.
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from database import append_frames, run_writer
+from pandas import DataFrame, concat
+
+GROUP_COMMIT_ROWS = 100_000
+GROUP_COMMIT_MS = 10
+
+
+@dataclass
+class WriteBatch:
+    frames: List[Tuple]
+    future: asyncio.Future
+    rows: int = field(init=False)
+
+    def __post_init__(self):
+        self.rows = sum(len(frame[1]) for frame in self.frames)
+
+
+# Frames with the same table, columns and INSERT clause are concatenated, so a
+# group costs one INSERT per table rather than one per batch. A frame is a
+# (table, DataFrame) pair, or a triple whose clause is appended to its INSERT.
+def coalesce(frames: List[Tuple]) -> List[Tuple[str, DataFrame, str]]:
+    grouped: Dict[Tuple[str, tuple, str], List[DataFrame]] = {}
+    for table, df, *clause in frames:
+        if len(df):
+            key = (table, tuple(df.columns), "".join(clause))
+            grouped.setdefault(key, []).append(df)
+    return [
+        (table, concat(dfs, ignore_index=True), clause)
+        for (table, _, clause), dfs in grouped.items()
+    ]
+
+
+class IngestQueue:
+    def __init__(self, max_rows=GROUP_COMMIT_ROWS, max_delay_ms=GROUP_COMMIT_MS):
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000
+        self.commits = 0
+        self._queue = None
+        self._writer = None
+
+    # The writer task belongs to the running loop; a new loop gets a new writer
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        writer = self._writer
+        if writer is None or writer.done() or writer.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._writer = loop.create_task(self._run())
+
+    # Resolves to the number of rows written once the frames are committed
+    async def submit(self, frames: List[Tuple]) -> int:
+        self._start()
+        batch = WriteBatch(frames, asyncio.get_running_loop().create_future())
+        if batch.rows == 0:
+            return 0
+        await self._queue.put(batch)
+        return await batch.future
+
+    async def _collect(self) -> List[WriteBatch]:
+        loop = asyncio.get_running_loop()
+        group = [await self._queue.get()]
+        rows = group[0].rows
+        deadline = loop.time() + self.max_delay
+        while rows < self.max_rows:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            group.append(batch)
+            rows += batch.rows
+        return group
+
+    async def _commit(self, group: List[WriteBatch]):
+        frames = coalesce([frame for batch in group for frame in batch.frames])
+        try:
+            await run_writer(append_frames, frames)
+        except Exception as e:
+            if len(group) == 1:
+                if not group[0].future.done():
+                    group[0].future.set_exception(e)
+                return
+            # Retry the batches one at a time, so only the bad ones fail
+            for batch in group:
+                await self._commit([batch])
+            return
+        self.commits += 1
+        for batch in group:
+            if not batch.future.done():
+                batch.future.set_result(batch.rows)
+
+    async def _run(self):
+        while True:
+            await self._commit(await self._collect())
+
+
+INGEST_QUEUE = IngestQueue()
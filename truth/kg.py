@@ -1,10 +1,28 @@
-from dataclasses import dataclass, field
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, fields
 from datetime import date
-from typing import List
-
-from database import Database, allocate_ids
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from adjacency import ADJACENCY
+from canonical import CANONICAL_IDS
+from database import (
+    allocate_ids,
+    get_session,
+    insert_frame,
+    pooled_connection,
+    raw_transaction,
+    run_reader,
+    run_writer,
+)
 from fquery.sqlmodel import SQL_PK, model
+from ingest import INGEST_QUEUE
+from pandas import DataFrame
+from sqlalchemy import literal, text, union_all
 from sqlmodel import SQLModel, select
+from views import PROBABILITY_VIEWS
 
 
 @model(global_id=True)
@@ -21,62 +39,69 @@ class PropertyType:
     id: int | None = None
 
 
+# While set, @graph objects are plain in-memory records: constructing them does
+# no database I/O until they are handed to save_instances
+DETACHED: ContextVar[bool] = ContextVar("detached", default=False)
+
+
+@contextmanager
+def detached():
+    token = DETACHED.set(True)
+    try:
+        yield
+    finally:
+        DETACHED.reset(token)
+
+
 class GraphBase:
+    # Only the type is looked up here; the save call that inserts the object
+    # writes its InstanceOf row
     def create_object_type_relation(self, derived):
         if not hasattr(derived, "TYPE"):
             self.create_object_type(derived)
-        db = Database().db
-        with db as session:
-            session.add(
-                TypeRelation(
-                    src=self.id, rtype=InstanceOf.TYPE.id, dst=self.__class__.TYPE.id
-                ).sqlmodel()
-            )
-            session.commit()
 
     @classmethod
     def create_object_type(cls, derived):
         cls = derived
         # check if ObjectType exists in db
-        db = Database().db
         obj_sqlmodel = ObjectType(cls.__name__).sqlmodel()
         ObjectTypeSQLModel = obj_sqlmodel.__class__
         statement = select(ObjectTypeSQLModel).where(
             ObjectTypeSQLModel.name == cls.__name__
         )
-        result = db.exec(statement).first()
-        if result is None:
-            with db as session:
+        with get_session(write=True) as session:
+            result = session.exec(statement).first()
+            if result is None:
                 session.add(obj_sqlmodel)
                 session.commit()
                 session.refresh(obj_sqlmodel)
-        else:
-            obj_sqlmodel = result
-        cls.TYPE = ObjectType(obj_sqlmodel.name, obj_sqlmodel.id)
+            else:
+                obj_sqlmodel = result
+            cls.TYPE = ObjectType(obj_sqlmodel.name, obj_sqlmodel.id)
 
     def __post_init__(self):
-        self.create_object_type_relation(self.__class__)
+        if not DETACHED.get():
+            self.create_object_type_relation(self.__class__)
 
 
 class PropertyBase:
     @classmethod
     def create_property_type(cls):
         # check if PropertyType exists in db
-        db = Database().db
         prop_sqlmodel = PropertyType(cls.__name__).sqlmodel()
         PropertyTypeSQLModel = prop_sqlmodel.__class__
         statement = select(PropertyTypeSQLModel).where(
             PropertyTypeSQLModel.name == cls.__name__
         )
-        result = db.exec(statement).first()
-        if result is None:
-            with db as session:
+        with get_session(write=True) as session:
+            result = session.exec(statement).first()
+            if result is None:
                 session.add(prop_sqlmodel)
                 session.commit()
                 session.refresh(prop_sqlmodel)
-        else:
-            prop_sqlmodel = result
-        cls.TYPE = PropertyType(prop_sqlmodel.name, prop_sqlmodel.id)
+            else:
+                prop_sqlmodel = result
+            cls.TYPE = PropertyType(prop_sqlmodel.name, prop_sqlmodel.id)
 
     def __post_init__(self):
         if not hasattr(self.__class__, "TYPE"):
@@ -101,12 +126,144 @@ def inject_property_base(cls):
     return type(cls.__name__, (PropertyBase,), {**cls.__dict__, **extras})
 
 
-def graph(cls):
-    return model(global_id=True)(dataclass(inject_base(cls)))
+# Every @graph / @property class, so their types can be registered in bulk
+GRAPH_CLASSES = []
+PROPERTY_CLASSES = []
+
+
+# key names the natural key columns that save_objs(upsert=True) matches on,
+# e.g. @graph(key="name"). Classes without one can't be upserted, and get no
+# unique index.
+def graph(cls=None, *, key=None):
+    def wrap(cls):
+        cls = model(global_id=True)(dataclass(inject_base(cls)))
+        if key is None:
+            cls.KEY = None
+        else:
+            cls.KEY = (key,) if isinstance(key, str) else tuple(key)
+        GRAPH_CLASSES.append(cls)
+        return cls
+
+    if cls is None:
+        return wrap
+    return wrap(cls)
 
 
 def property(cls):
-    return dataclass(inject_property_base(cls))
+    cls = dataclass(inject_property_base(cls))
+    PROPERTY_CLASSES.append(cls)
+    return cls
+
+
+# Loads all ObjectType and PropertyType rows in one query, inserts the missing
+# ones in one batch and sets TYPE on every registered class, so no class needs
+# its own lookup on first use
+def load_schema_registry():
+    migrate_relations_key()
+    ObjectTypeSQLModel = ObjectType.__sqlmodel__
+    PropertyTypeSQLModel = PropertyType.__sqlmodel__
+    statement = union_all(
+        select(
+            literal(ObjectType.__name__).label("kind"),
+            ObjectTypeSQLModel.name,
+            ObjectTypeSQLModel.id,
+        ),
+        select(
+            literal(PropertyType.__name__),
+            PropertyTypeSQLModel.name,
+            PropertyTypeSQLModel.id,
+        ),
+    )
+    with get_session() as session:
+        known = {(kind, name): id for kind, name, id in session.exec(statement).all()}
+
+    wanted = [(ObjectType, cls) for cls in GRAPH_CLASSES]
+    wanted += [(PropertyType, cls) for cls in PROPERTY_CLASSES]
+    missing = [
+        (type_class, cls)
+        for type_class, cls in wanted
+        if (type_class.__name__, cls.__name__) not in known
+    ]
+    if missing:
+        with get_session(write=True) as session:
+            for (type_class, cls), type_id in zip(missing, allocate_ids(len(missing))):
+                known[(type_class.__name__, cls.__name__)] = type_id
+                session.add(type_class(cls.__name__, type_id).sqlmodel())
+            session.commit()
+
+    for type_class, cls in wanted:
+        cls.TYPE = type_class(cls.__name__, known[(type_class.__name__, cls.__name__)])
+    create_key_indexes()
+
+
+# Rows saved before the key was enforced may repeat it (e.g. a "Root" Topic per
+# serum run). Like CanonicalIndex.load, the oldest row wins: edges of the
+# newer ones move to it and the newer rows are deleted. Returns how many were.
+def merge_duplicate_keys(duck, cls) -> int:
+    table = table_name(cls)
+    columns = ", ".join(f'"{c}"' for c in cls.KEY)
+    duck.execute(
+        f"""
+        CREATE TEMP TABLE _merged AS
+        SELECT id, min(id) OVER (PARTITION BY {columns}) AS keep FROM {table}
+        """
+    )
+    duck.execute("DELETE FROM _merged WHERE id = keep")
+    try:
+        merged = duck.execute("SELECT count(*) FROM _merged").fetchone()[0]
+        if not merged:
+            return 0
+        relations = table_name(Relation)
+        remap = {
+            c: f"coalesce((SELECT keep FROM _merged WHERE id = r.{c}), r.{c})"
+            for c in ("src", "dst", "viewpoint")
+        }
+        moved = "r.src IN (SELECT id FROM _merged) OR r.dst IN (SELECT id FROM _merged)"
+        moved += " OR r.viewpoint IN (SELECT id FROM _merged)"
+        duck.execute(
+            f"""
+            INSERT INTO {relations}
+                (src, rtype, dst, start, "end", probability, viewpoint)
+            SELECT {remap["src"]}, rtype, {remap["dst"]}, start, "end",
+                   probability, {remap["viewpoint"]}
+            FROM {relations} r WHERE {moved}
+            ON CONFLICT DO NOTHING
+            """
+        )
+        duck.execute(f"DELETE FROM {relations} r WHERE {moved}")
+        for merged_table, column in ((table_name(TypeRelation), "src"), (table, "id")):
+            duck.execute(
+                f"DELETE FROM {merged_table} WHERE {column} IN (SELECT id FROM _merged)"
+            )
+        return merged
+    finally:
+        duck.execute("DROP TABLE _merged")
+
+
+# The unique index each keyed @graph table needs for upsert_objs' ON CONFLICT,
+# created once at startup rather than inside every upsert
+def create_key_indexes():
+    keyed = [cls for cls in GRAPH_CLASSES if cls.KEY is not None]
+    if not keyed:
+        return
+    for cls in keyed:
+        table = table_name(cls)
+        with raw_transaction() as duck:
+            indexed = duck.execute(
+                "SELECT count(*) FROM duckdb_indexes() WHERE index_name = ?",
+                [f"{table}_key"],
+            ).fetchone()[0]
+            if indexed:
+                continue
+            merged = merge_duplicate_keys(duck, cls)
+        if merged:
+            CANONICAL_IDS.forget(cls)
+            print(f"Merged {merged} {table} rows that repeated a key")
+        # DuckDB builds the index over committed rows only, so this can't share
+        # the transaction that deleted the duplicates
+        columns = ", ".join(f'"{c}"' for c in cls.KEY)
+        with raw_transaction() as duck:
+            duck.execute(f"CREATE UNIQUE INDEX {table}_key ON {table} ({columns})")
 
 
 INFINITY_DATE = date.max
@@ -121,7 +278,43 @@ class Relation:
     start: date = field(default_factory=date.today)
     end: date | None = field(default_factory=lambda: INFINITY_DATE)
     probability: float = field(default_factory=lambda: 1.0)
-    viewpoint: int | None = 0
+    # Part of the key, so each viewpoint can hold its own copy of an edge
+    viewpoint: int = field(default=0, **SQL_PK)
+
+
+# create_all leaves existing tables alone, so a kg.db created before viewpoint
+# joined the key still has (src, rtype, dst) as its primary key, and a second
+# viewpoint's copy of an edge would violate it. Such a table is rebuilt once
+# with the current key, treating NULL viewpoints as 0.
+def migrate_relations_key():
+    table = table_name(Relation)
+    with pooled_connection() as duck:
+        keys = duck.execute(
+            """
+            SELECT constraint_column_names FROM duckdb_constraints()
+            WHERE table_name = ? AND constraint_type = 'PRIMARY KEY'
+            """,
+            [table],
+        ).fetchall()
+    if not keys or "viewpoint" in keys[0][0]:
+        return
+    columns = ", ".join(f'"{f.name}"' for f in fields(Relation))
+    with get_session(write=True) as session:
+        conn = session.connection()
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_old"))
+        Relation.__sqlmodel__.__table__.create(conn, checkfirst=True)
+        conn.execute(
+            text(
+                f"""
+                INSERT INTO {table} ({columns})
+                SELECT src, rtype, dst, start, "end", probability,
+                    COALESCE(viewpoint, 0)
+                FROM {table}_old
+                """
+            )
+        )
+        conn.execute(text(f"DROP TABLE {table}_old"))
+        session.commit()
 
 
 @model(global_id=True)
@@ -137,62 +330,390 @@ class InstanceOf:
     pass
 
 
+def instance_of_id() -> int:
+    if not hasattr(InstanceOf, "TYPE"):
+        InstanceOf.create_property_type()
+    return InstanceOf.TYPE.id
+
+
+# Keeps the in-memory indexes in step with committed relations
+def index_edges(src, rtype: int, dst, probabilities=None, viewpoint=0):
+    ADJACENCY.add_edges(src, rtype, dst, viewpoint=viewpoint)
+    PROBABILITY_VIEWS.add_edges(src, rtype, dst, probabilities, viewpoint)
+
+
+def edges_columns(edges: List[Tuple[int, int]]) -> Tuple[List[int], List[int]]:
+    return [src for src, _ in edges], [dst for _, dst in edges]
+
+
+def table_name(cls) -> str:
+    return cls.__sqlmodel__.__tablename__
+
+
+# Columnar equivalents of constructing one @graph object / Relation per row
+def node_frame(model_class, values: List, ids: List[int]) -> DataFrame:
+    return DataFrame({fields(model_class)[0].name: values, "id": ids})
+
+
+def relation_frame(src, rtype: int, dst, **columns) -> DataFrame:
+    defaults = Relation(src=0, rtype=rtype, dst=0)
+    return DataFrame(
+        {
+            "src": src,
+            "rtype": rtype,
+            "dst": dst,
+            "start": columns.get("start", defaults.start),
+            "end": columns.get("end", defaults.end),
+            "probability": columns.get("probability", defaults.probability),
+            "viewpoint": columns.get("viewpoint", defaults.viewpoint),
+        }
+    )
+
+
+def type_relation_frame(model_class, ids: List[int]) -> DataFrame:
+    if not hasattr(model_class, "TYPE"):
+        model_class.create_object_type(model_class)
+    return DataFrame(
+        {"src": ids, "rtype": instance_of_id(), "dst": model_class.TYPE.id}
+    )
+
+
+# Edges that a save has picked for insertion but not committed yet. new_edges
+# skips them, so concurrent saves of one edge don't both write it.
+PENDING_EDGES = set()
+PENDING_LOCK = Lock()
+
+
+# Edges of rtype in viewpoint among the given (src, dst) pairs that are not
+# saved yet, deduplicated and in input order. They stay claimed until the
+# caller hands them to release_edges.
+def new_edges(rtype: int, pairs, viewpoint=0) -> List[Tuple[int, int]]:
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        return pairs
+    with pooled_connection() as duck:
+        existing = duck.execute(
+            """
+            SELECT src, dst FROM relations
+            WHERE rtype = ? AND viewpoint = ? AND src IN (SELECT unnest(?))
+            """,
+            [rtype, viewpoint, list({src for src, _ in pairs})],
+        ).fetchall()
+    existing = set(existing)
+    with PENDING_LOCK:
+        edges = [
+            (src, dst)
+            for src, dst in pairs
+            if (src, dst) not in existing
+            and (rtype, viewpoint, src, dst) not in PENDING_EDGES
+        ]
+        PENDING_EDGES.update((rtype, viewpoint, src, dst) for src, dst in edges)
+    return edges
+
+
+def release_edges(rtype: int, edges: List[Tuple[int, int]], viewpoint=0):
+    with PENDING_LOCK:
+        PENDING_EDGES.difference_update(
+            (rtype, viewpoint, src, dst) for src, dst in edges
+        )
+
+
+# Nodes held from CANONICAL_IDS may also be written by the save that allocated
+# them, so whichever commits second skips them
+SHARED_NODES = "ON CONFLICT DO NOTHING"
+
+
+# The held nodes, their InstanceOf rows and the new edges of a save, as one
+# DataFrame per table for the ingest queue. probabilities, if given, has one
+# value per edge.
+def graph_frames(
+    held_nodes: List[Tuple[SQLModel, List]],
+    edges: List[Tuple[int, int]],
+    rtype: int,
+    viewpoint=0,
+    probabilities: List[float] | None = None,
+) -> List[Tuple[str, DataFrame]]:
+    frames = []
+    for model_class, held in held_nodes:
+        if held:
+            values, ids = map(list, zip(*held))
+            nodes = node_frame(model_class, values, ids)
+            types = type_relation_frame(model_class, ids)
+            frames.append((table_name(model_class), nodes, SHARED_NODES))
+            frames.append((table_name(TypeRelation), types, SHARED_NODES))
+    if edges:
+        src, dst = map(list, zip(*edges))
+        columns = {"viewpoint": viewpoint}
+        if probabilities is not None:
+            columns["probability"] = probabilities
+        relations = relation_frame(src, rtype, dst, **columns)
+        frames.append((table_name(Relation), relations))
+    return frames
+
+
+# Loading a class's map reads its whole node table and allocating ids may reach
+# the sequence, so the async save functions run this on a worker thread
+def canonicalize(
+    model_class, values: List
+) -> Tuple[List[int], List[Tuple], List[Tuple]]:
+    return CANONICAL_IDS.canonicalize(model_class, values)
+
+
+# Settles the nodes a save held, once its frames committed or failed
+def settle(held_nodes: List[Tuple[SQLModel, List]], saved: bool):
+    for model_class, held in held_nodes:
+        CANONICAL_IDS.settle(model_class, held, saved)
+
+
+# Both sides are canonicalized by name, so rerunning an extraction reuses the
+# existing nodes and skips edges that are already saved. The rows are written
+# through the ingest queue, so concurrent callers share commits.
 async def save_graph(
-    rows: List, left_model: SQLModel, right_model: SQLModel, relation_class: Relation
+    rows: List,
+    left_model: SQLModel,
+    right_model: SQLModel,
+    relation_class: Relation,
+    viewpoint=0,
 ) -> int:
-    ids = allocate_ids(2 * len(rows))
-
-    with Database().db as session:
-        for left, right, *_ in rows:
-            left_obj = left_model(left).sqlmodel()
-            right_obj = right_model(right).sqlmodel()
-            left_obj.id = ids.pop(0)
-            right_obj.id = ids.pop(0)
-            session.add(left_obj)
-            session.add(right_obj)
-            relation = Relation(
-                src=left_obj.id,
-                rtype=relation_class.TYPE.id,
-                dst=right_obj.id,
-            )
-            session.add(relation.sqlmodel())
-        session.commit()
+    rtype = relation_class.TYPE.id
+    held_nodes = []
+    saved = False
+    try:
+        lefts = [row[0] for row in rows]
+        rights = [row[1] for row in rows]
+        left_ids, _, held = await run_reader(canonicalize, left_model, lefts)
+        held_nodes.append((left_model, held))
+        right_ids, _, held = await run_reader(canonicalize, right_model, rights)
+        held_nodes.append((right_model, held))
+        pairs = list(zip(left_ids, right_ids))
+        edges = await run_reader(new_edges, rtype, pairs, viewpoint)
+        try:
+            frames = graph_frames(held_nodes, edges, rtype, viewpoint)
+            await INGEST_QUEUE.submit(frames)
+            saved = True
+        finally:
+            release_edges(rtype, edges, viewpoint)
+    finally:
+        settle(held_nodes, saved)
+    src, dst = edges_columns(edges)
+    index_edges(src, rtype, dst, viewpoint=viewpoint)
     return len(rows)
 
 
-# Unlike save_graph, this saves only objects of a given type. Relations to be added later
-async def save_objs(rows: List, left_model: SQLModel, refresh=False) -> List[SQLModel]:
-    ids = allocate_ids(len(rows))
-    objs = []
-
-    with Database().db as session:
-        for left in rows:
-            left_obj = left_model(*left).sqlmodel()
-            left_obj.id = ids.pop(0)
-            objs.append(left_obj)
-            session.add(left_obj)
-        session.commit()
-        if refresh:
-            [session.refresh(o) for o in objs]
+# Builds the dataclass objects for rows without any database I/O; the save
+# call writes their InstanceOf rows itself
+def build_objs(model_class, rows: List) -> List:
+    with detached():
+        objs = [model_class(*row) for row in rows]
+    for obj, obj_id in zip(objs, allocate_ids(len(objs))):
+        obj.id = obj_id
     return objs
 
 
+def objs_frame(model_class, objs: List) -> DataFrame:
+    columns = [f.name for f in fields(model_class)]
+    return DataFrame({c: [getattr(obj, c) for obj in objs] for c in columns})
+
+
+def returning(model_class) -> str:
+    columns = model_class.__sqlmodel__.model_fields
+    return "RETURNING " + ", ".join(f'"{c}"' for c in columns)
+
+
+# sqlmodel objects by id from the rows of a returning(model_class) clause
+def hydrate(model_class, saved: List[tuple]) -> Dict[int, SQLModel]:
+    SQLModelClass = model_class.__sqlmodel__
+    columns = list(SQLModelClass.model_fields)
+    objs = [SQLModelClass(**dict(zip(columns, row))) for row in saved]
+    return {obj.id: obj for obj in objs}
+
+
+def remember_objs(model_class, objs: List):
+    first = fields(model_class)[0].name
+    values = [getattr(obj, first) for obj in objs]
+    CANONICAL_IDS.remember(model_class, values, [obj.id for obj in objs])
+
+
+# Inserts new rows and updates the ones whose natural key is already saved,
+# with one INSERT ... ON CONFLICT per batch. The saved rows come back through
+# RETURNING, so the returned objects need no refresh.
+def upsert_objs(rows: List, model_class: SQLModel) -> List[SQLModel]:
+    if model_class.KEY is None:
+        raise ValueError(f"{model_class.__name__} has no key to upsert on")
+    objs = build_objs(model_class, rows)
+    keys = [tuple(getattr(obj, k) for k in model_class.KEY) for obj in objs]
+    # Within a batch the last row for a key wins
+    latest = dict(zip(keys, objs))
+
+    table = table_name(model_class)
+    key_columns = ", ".join(f'"{c}"' for c in model_class.KEY)
+    updates = ", ".join(
+        f'"{f.name}" = excluded."{f.name}"'
+        for f in fields(model_class)
+        if f.name != "id"
+    )
+    with raw_transaction() as duck:
+        saved = insert_frame(
+            duck,
+            table,
+            objs_frame(model_class, latest.values()),
+            f"ON CONFLICT ({key_columns}) DO UPDATE SET {updates} "
+            + returning(model_class),
+        )
+        saved = hydrate(model_class, saved)
+        # Rows that kept their freshly allocated id were inserted, not updated
+        new_ids = [obj.id for obj in latest.values() if obj.id in saved]
+        if new_ids:
+            types = type_relation_frame(model_class, new_ids)
+            insert_frame(duck, table_name(TypeRelation), types)
+
+    by_key = {
+        tuple(getattr(obj, k) for k in model_class.KEY): obj for obj in saved.values()
+    }
+    remember_objs(model_class, by_key.values())
+    # One object per row, holding what was saved for its key
+    return [by_key[key] for key in keys]
+
+
+# With refresh=True every column comes back through RETURNING, one statement
+# for the batch instead of a session.refresh per object
+def insert_objs(rows: List, left_model: SQLModel) -> List[SQLModel]:
+    objs = build_objs(left_model, rows)
+    ids = [obj.id for obj in objs]
+    with raw_transaction() as duck:
+        saved = insert_frame(
+            duck,
+            table_name(left_model),
+            objs_frame(left_model, objs),
+            returning(left_model),
+        )
+        types = type_relation_frame(left_model, ids)
+        insert_frame(duck, table_name(TypeRelation), types)
+    remember_objs(left_model, objs)
+    saved = hydrate(left_model, saved)
+    return [saved[obj_id] for obj_id in ids]
+
+
+# Unlike save_graph, this saves only objects of a given type. Relations to be added later
+# Plain inserts go through the ingest queue; upserts and refreshes need their
+# own RETURNING statement and run on a worker thread under the write lock
+async def save_objs(
+    rows: List, left_model: SQLModel, refresh=False, upsert=False
+) -> List[SQLModel]:
+    if not rows:
+        return []
+    if upsert:
+        return await run_writer(upsert_objs, rows, left_model)
+    if refresh:
+        return await run_writer(insert_objs, rows, left_model)
+    objs = build_objs(left_model, rows)
+    types = type_relation_frame(left_model, [obj.id for obj in objs])
+    await INGEST_QUEUE.submit(
+        [
+            (table_name(left_model), objs_frame(left_model, objs)),
+            (table_name(TypeRelation), types),
+        ]
+    )
+    remember_objs(left_model, objs)
+    return [obj.sqlmodel() for obj in objs]
+
+
 async def save_graph_prob(
-    left_id: int, rows: List, right_model: SQLModel, relation_class: Relation
+    left_id: int,
+    rows: List,
+    right_model: SQLModel,
+    relation_class: Relation,
+    viewpoint=0,
 ) -> int:
-    ids = allocate_ids(len(rows))
-
-    with Database().db as session:
-        for right, prob, *_ in rows:
-            right_obj = right_model(right).sqlmodel()
-            right_obj.id = ids.pop(0)
-            session.add(right_obj)
-            relation = Relation(
-                src=left_id,
-                rtype=relation_class.TYPE.id,
-                dst=right_obj.id,
-                probability=prob,
-            )
-            session.add(relation.sqlmodel())
-        session.commit()
+    rtype = relation_class.TYPE.id
+    held_nodes = []
+    saved = False
+    try:
+        rights = [row[0] for row in rows]
+        right_ids, _, held = await run_reader(canonicalize, right_model, rights)
+        held_nodes.append((right_model, held))
+        probability = {}
+        for (_, prob, *_), right_id in zip(rows, right_ids):
+            probability.setdefault(right_id, float(prob))
+        pairs = [(left_id, id) for id in right_ids]
+        edges = await run_reader(new_edges, rtype, pairs, viewpoint)
+        probabilities = [probability[dst] for _, dst in edges]
+        try:
+            frames = graph_frames(held_nodes, edges, rtype, viewpoint, probabilities)
+            await INGEST_QUEUE.submit(frames)
+            saved = True
+        finally:
+            release_edges(rtype, edges, viewpoint)
+    finally:
+        settle(held_nodes, saved)
+    src, dst = edges_columns(edges)
+    index_edges(src, rtype, dst, probabilities, viewpoint)
     return len(rows)
+
+
+# Saves edges between nodes that already exist, as one DataFrame append
+async def save_relations(
+    src: List[int],
+    relation_class: Relation,
+    dst: List[int],
+    probabilities: List[float] | None = None,
+    viewpoint=0,
+) -> int:
+    columns = {"viewpoint": viewpoint}
+    if probabilities is not None:
+        columns["probability"] = probabilities
+    rtype = relation_class.TYPE.id
+    frames = [(table_name(Relation), relation_frame(src, rtype, dst, **columns))]
+    await INGEST_QUEUE.submit(frames)
+    index_edges(src, rtype, dst, probabilities, viewpoint)
+    return len(src)
+
+
+# Objects without an id take the canonical id of their name, like the nodes of
+# save_graph. Returns the objects to insert, those that were given an id and one
+# object per held name, along with the held nodes.
+def canonical_objs(model_class, objs: List) -> Tuple[List, List[Tuple]]:
+    preset = [obj for obj in objs if obj.id is not None]
+    unsaved = [obj for obj in objs if obj.id is None]
+    name = fields(model_class)[0].name
+    ids, _, held = CANONICAL_IDS.canonicalize(
+        model_class, [getattr(obj, name) for obj in unsaved]
+    )
+    remember_objs(model_class, preset)
+    held_ids = {obj_id for _, obj_id in held}
+    inserts = {}
+    for obj, obj_id in zip(unsaved, ids):
+        obj.id = obj_id
+        if obj_id in held_ids:
+            inserts.setdefault(obj_id, obj)
+    return preset + list(inserts.values()), held
+
+
+# Saves @graph objects built under detached(). Objects without an id get one in
+# place, and each class's new objects are appended as one DataFrame along with
+# their InstanceOf edges. Objects given an id may be nodes the caller holds, so
+# they are written like held nodes.
+async def save_instances(objs: List) -> List:
+    by_class = defaultdict(list)
+    for obj in objs:
+        by_class[obj.__class__].append(obj)
+    held_nodes = []
+    saved = False
+    try:
+        frames = []
+        for cls, group in by_class.items():
+            inserts, held = await run_reader(canonical_objs, cls, group)
+            held_nodes.append((cls, held))
+            if not inserts:
+                continue
+            columns = {
+                f.name: [getattr(obj, f.name) for obj in inserts] for f in fields(cls)
+            }
+            types = type_relation_frame(cls, columns["id"])
+            frames.append((table_name(cls), DataFrame(columns), SHARED_NODES))
+            frames.append((table_name(TypeRelation), types, SHARED_NODES))
+        await INGEST_QUEUE.submit(frames)
+        saved = True
+    finally:
+        settle(held_nodes, saved)
+    return objs
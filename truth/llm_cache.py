@@ -0,0 +1,103 @@
+# Content-addressed cache of LLM completions, keyed by model, prompt and
+# generation parameters and stored in its own DuckDB file. Entries are evicted
+# least recently used first once the cached completions exceed max_bytes.
+
+import hashlib
+import json
+from datetime import datetime
+
+import duckdb
+
+CACHE_PATH = "llm_cache.db"
+# Total size of cached completions kept, in bytes
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def cache_key(model: str, prompt: str, params: dict) -> str:
+    payload = json.dumps([model, prompt, params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class PromptCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.conn = duckdb.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS completions (
+                key VARCHAR PRIMARY KEY,
+                model VARCHAR,
+                prompt VARCHAR,
+                params JSON,
+                completion VARCHAR,
+                size BIGINT,
+                created TIMESTAMP,
+                last_access TIMESTAMP
+            )
+            """
+        )
+
+    def get(self, model: str, prompt: str, params: dict) -> str | None:
+        key = cache_key(model, prompt, params)
+        row = self.conn.execute(
+            """
+            UPDATE completions SET last_access = ? WHERE key = ?
+            RETURNING completion
+            """,
+            [datetime.now(), key],
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, model: str, prompt: str, params: dict, completion: str):
+        key = cache_key(model, prompt, params)
+        now = datetime.now()
+        self.conn.execute(
+            """
+            INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                key,
+                model,
+                prompt,
+                json.dumps(params, sort_keys=True, default=str),
+                completion,
+                len(completion.encode()),
+                now,
+                now,
+            ],
+        )
+        self.evict()
+
+    # Drops the least recently used entries beyond max_bytes in one statement
+    def evict(self):
+        self.conn.execute(
+            """
+            DELETE FROM completions WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, sum(size) OVER (
+                        ORDER BY last_access DESC, key
+                    ) AS kept
+                    FROM completions
+                )
+                WHERE kept > ?
+            )
+            """,
+            [self.max_bytes],
+        )
+
+    def stats(self) -> dict:
+        entries, size = self.conn.execute(
+            "SELECT count(*), coalesce(sum(size), 0) FROM completions"
+        ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": size,
+        }
@@ -0,0 +1,252 @@
+# Resolves LLM-produced place names ("USA", "Washington, D.C.") to gazetteer
+# ids in world.db. Normalized names and country codes are a dict lookup; the
+# rest go through a trigram index held as numpy postings and are scored by
+# Dice similarity, one batch at a time.
+
+import time
+from threading import Lock
+from typing import Iterable, List, Tuple
+
+import duckdb
+import numpy as np
+from canonical import normalize
+
+WORLD_PATH = "world.db"
+# Fuzzy matches below this Dice similarity resolve to -1
+MIN_SIMILARITY = 0.5
+# Postings a fuzzy key may scan for candidates, spent on its rarest trigrams;
+# common trigrams still count towards the similarity
+POSTING_BUDGET = 256
+# Candidates per name that get an exact similarity score
+CANDIDATES = 8
+
+
+def trigrams(key: str) -> List[str]:
+    padded = f"  {key} "
+    return list({padded[i : i + 3] for i in range(len(padded) - 2)})
+
+
+# Concatenated values[offsets[r]:offsets[r + 1]] for each r in rows, and the
+# length of each slice
+def gather(offsets, values, rows) -> Tuple[np.ndarray, np.ndarray]:
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    ends = np.cumsum(lengths)
+    index = np.repeat(starts - (ends - lengths), lengths) + np.arange(
+        ends[-1] if len(ends) else 0
+    )
+    return values[index], lengths
+
+
+# Index positions of the first row of each run of equal values in sorted keys
+def group_starts(keys: np.ndarray) -> np.ndarray:
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+class NameIndex:
+    # aliases are (position, alias) pairs; they never shadow a real name, and
+    # of two names that normalize alike the first (lowest id) wins
+    def __init__(self, ids, names: List[str], aliases: Iterable = ()):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        keys = [normalize(name) for name in names]
+        self.exact = {}
+        for position, key in enumerate(keys):
+            self.exact.setdefault(key, position)
+        for position, alias in aliases:
+            self.exact.setdefault(normalize(alias), position)
+
+        self.vocab = {}
+        grams = []
+        for key in keys:
+            grams.append(
+                [self.vocab.setdefault(g, len(self.vocab)) for g in trigrams(key)]
+            )
+        self.sizes = np.array([len(g) for g in grams], dtype=np.int64)
+        # name -> trigram ids and trigram id -> names, both as CSR arrays
+        self.name_offsets = np.r_[0, np.cumsum(self.sizes)]
+        self.name_grams = np.fromiter(
+            (g for name in grams for g in name),
+            dtype=np.int64,
+            count=self.name_offsets[-1],
+        )
+        owners = np.repeat(np.arange(len(keys)), self.sizes)
+        order = np.argsort(self.name_grams, kind="stable")
+        self.postings = owners[order]
+        self.df = np.bincount(self.name_grams, minlength=len(self.vocab))
+        self.offsets = np.r_[0, np.cumsum(self.df)]
+
+    # Gazetteer ids for names, -1 where nothing is similar enough
+    def resolve(self, names: Iterable[str]) -> np.ndarray:
+        keys = [normalize(name) for name in names]
+        unique = list(dict.fromkeys(keys))
+        positions = np.array(
+            [self.exact.get(key, -1) for key in unique], dtype=np.int64
+        )
+        misses = np.flatnonzero(positions < 0)
+        if len(misses):
+            positions[misses] = self.fuzzy([unique[i] for i in misses])
+        by_key = dict(zip(unique, positions.tolist()))
+        positions = np.array([by_key[key] for key in keys], dtype=np.int64)
+        return np.where(positions >= 0, self.ids[positions], -1)
+
+    # Best matching positions for normalized keys, -1 below MIN_SIMILARITY
+    def fuzzy(self, keys: List[str]) -> np.ndarray:
+        result = np.full(len(keys), -1, dtype=np.int64)
+        key_grams = [trigrams(key) for key in keys]
+        query_sizes = np.array([len(grams) for grams in key_grams], dtype=np.int64)
+        tids = np.array(
+            [self.vocab.get(g, -1) for grams in key_grams for g in grams],
+            dtype=np.int64,
+        )
+        owner = np.repeat(np.arange(len(keys)), query_sizes)
+        known = tids >= 0
+        tids, owner = tids[known], owner[known]
+        if len(tids) == 0:
+            return result
+
+        # Each key proposes candidates from its rarest trigrams, up to
+        # POSTING_BUDGET postings (and at least its rarest one)
+        df = self.df[tids]
+        order = np.lexsort((df, owner))
+        tids, owner, df = tids[order], owner[order], df[order]
+        starts = group_starts(owner)
+        before = np.cumsum(df) - df
+        within = before - np.repeat(before[starts], np.diff(np.r_[starts, len(df)]))
+        selective = within + df <= POSTING_BUDGET
+        selective[starts] = True
+
+        # Candidates: the names sharing the most selective trigrams with a key
+        n = len(self.ids)
+        entries, lengths = gather(self.offsets, self.postings, tids[selective])
+        pairs, votes = np.unique(
+            np.repeat(owner[selective], lengths) * n + entries, return_counts=True
+        )
+        order = np.lexsort((-votes, pairs // n))
+        query, name = pairs[order] // n, pairs[order] % n
+        starts = group_starts(query)
+        rank = np.arange(len(query)) - np.repeat(
+            starts, np.diff(np.r_[starts, len(query)])
+        )
+        query, name = query[rank < CANDIDATES], name[rank < CANDIDATES]
+
+        # Dice similarity over all trigrams of each (key, candidate) pair
+        vocab_size = len(self.vocab)
+        candidate = np.arange(len(query))
+        name_grams, name_lengths = gather(self.name_offsets, self.name_grams, name)
+        query_offsets = np.r_[0, np.cumsum(np.bincount(owner, minlength=len(keys)))]
+        query_grams, query_lengths = gather(query_offsets, tids, query)
+        name_pairs = np.repeat(candidate, name_lengths) * vocab_size + name_grams
+        query_pairs = np.repeat(candidate, query_lengths) * vocab_size + query_grams
+        shared = np.bincount(
+            np.repeat(candidate, name_lengths)[np.isin(name_pairs, query_pairs)],
+            minlength=len(candidate),
+        )
+        dice = 2 * shared / (query_sizes[query] + self.sizes[name])
+
+        order = np.lexsort((-dice, query))
+        best = order[group_starts(query[order])]
+        best = best[dice[best] >= MIN_SIMILARITY]
+        result[query[best]] = name[best]
+        return result
+
+
+# Name indexes over the countries and cities that import_cities.py wrote to
+# world.db, built on first use
+class Gazetteer:
+    def __init__(self, path=WORLD_PATH):
+        self.path = path
+        self.loaded = False
+        self._lock = Lock()
+
+    def load(self):
+        with duckdb.connect(self.path, read_only=True) as conn:
+            countries = conn.execute(
+                "SELECT id, name, iso2, iso3 FROM countries ORDER BY id"
+            ).fetchall()
+            cities = conn.execute("SELECT id, name FROM cities ORDER BY id").fetchall()
+        codes = [
+            (position, code)
+            for position, (_, _, iso2, iso3) in enumerate(countries)
+            for code in (iso2, iso3)
+            if code
+        ]
+        self.countries = NameIndex(
+            [row[0] for row in countries], [row[1] for row in countries], codes
+        )
+        self.cities = NameIndex([row[0] for row in cities], [row[1] for row in cities])
+        self.loaded = True
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.load()
+
+    def resolve_countries(self, names: Iterable[str]) -> np.ndarray:
+        self.ensure_loaded()
+        return self.countries.resolve(names)
+
+    def resolve_cities(self, names: Iterable[str]) -> np.ndarray:
+        self.ensure_loaded()
+        return self.cities.resolve(names)
+
+
+GAZETTEER = Gazetteer()
+
+
+def resolve_countries(names: Iterable[str]) -> np.ndarray:
+    return GAZETTEER.resolve_countries(names)
+
+
+def resolve_cities(names: Iterable[str]) -> np.ndarray:
+    return GAZETTEER.resolve_cities(names)
+
+
+def synthetic_names(num_names, rng) -> List[str]:
+    syllables = [c + v for c in "bcdfghjklmnprstvwz" for v in "aeiou"]
+    words = [
+        "".join(rng.choice(syllables, int(rng.integers(2, 5)))).title()
+        for _ in range(num_names * 2)
+    ]
+    # About one name in five has two words, like "San Felipe"
+    return [
+        f"{words[2 * i]} {words[2 * i + 1]}" if rng.random() < 0.2 else words[2 * i]
+        for i in range(num_names)
+    ]
+
+
+# A typo: one character dropped
+def misspell(name: str, rng) -> str:
+    i = int(rng.integers(0, len(name)))
+    return name[:i] + name[i + 1 :]
+
+
+def benchmark(num_names=150_000, num_lookups=100_000, fuzzy_fraction=0.1):
+    rng = np.random.default_rng(1)
+    names = synthetic_names(num_names, rng)
+    t = time.perf_counter()
+    index = NameIndex(np.arange(num_names), names)
+    print(f"indexed {num_names} names in {time.perf_counter() - t:.2f}s")
+    targets = rng.integers(0, num_names, num_lookups)
+    lookups = [
+        misspell(names[i], rng) if rng.random() < fuzzy_fraction else names[i].upper()
+        for i in targets
+    ]
+    # Names repeat, as real place names do; any id with the right name counts
+    keys = np.array([normalize(name) for name in names] + [None], dtype=object)
+
+    def names_of(ids):
+        return keys[ids]
+
+    t = time.perf_counter()
+    resolved = index.resolve(lookups)
+    elapsed = time.perf_counter() - t
+    print(
+        f"resolved {num_lookups} names ({fuzzy_fraction:.0%} misspelled) in "
+        f"{elapsed:.2f}s, {num_lookups / elapsed:,.0f} lookups/sec, "
+        f"{np.mean(names_of(resolved) == names_of(targets)):.1%} correct"
+    )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,7 +1,7 @@
 from kg import graph, property
 
 
-@graph
+@graph(key="name")
 class Topic:
     name: str
 
@@ -1,7 +1,7 @@
 from kg import graph
 
 
-@graph
+@graph(key="name")
 class Viewpoint:
     name: str
     description: str
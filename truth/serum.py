@@ -1,12 +1,11 @@
 import asyncio
 import csv
-import io
-import re
-from typing import List
 
 from database import engine
-from kg import InstanceOf, save_graph, save_graph_prob, save_objs
+from extract import Endpoint, ExtractionPool
+from kg import load_schema_registry, save_graph, save_graph_prob, save_objs
 from langchain_ollama import OllamaLLM
+from llm_cache import PromptCache
 from prefect import flow, task
 from prefect.logging import get_run_logger
 from schema.events import Event  # noqa F401: need this for the schema to be loaded
@@ -18,41 +17,46 @@ from schema.viewpoints import (  # noqa F401: need this for the schema to be loa
     Viewpoint,
 )
 from sqlmodel import SQLModel
+from topic_tree import TopicTree, subtopics
+from views import top_k
 
 LLM = OllamaLLM(model="qwen2.5:latest")
+LLM_CACHE = PromptCache()
+# A local Ollama server only runs a few generations in parallel; more just queue
+EXTRACTION_POOL = ExtractionPool([Endpoint(LLM, concurrency=4, cache=LLM_CACHE)])
+TOPIC_TREE_DEPTH = 3
+CONTINENTS = [
+    "Africa",
+    "Asia",
+    "Europe",
+    "North America",
+    "South America",
+    "Oceania",
+]
 
 
 SQLModel.metadata.create_all(engine)
 
 
-def extract_code(text):
-    pattern = r"```(\w+)\n(.*?)```"
-    match = re.search(pattern, text, re.DOTALL)
-    if match:
-        return match.group(2).strip()
-    else:
-        return None
-
-
 @task
-async def fetch_countries() -> List[Country]:
+async def fetch_countries() -> int:
     logger = get_run_logger()
-    # csv is fewer tokens than json
-    result = LLM.generate(
-        [
-            """Be short and complete. List 5 countries in the world in English and their capitals as csv.
+
+    async def save(rows):
+        logger.info(rows)
+        return await save_graph(rows, Country, City, CapitalRelation)
+
+    # csv is fewer tokens than json. One prompt per continent, run concurrently,
+    # with rows saved in micro-batches while the model is still generating
+    prompts = [
+        f"""Be short and complete. List 5 countries in {continent} in English and their capitals as csv.
             No headers, no explanation. One capital only"""
-        ]
+        for continent in CONTINENTS
+    ]
+    counts = await asyncio.gather(
+        *(EXTRACTION_POOL.stream(prompt, save) for prompt in prompts)
     )
-    text = result.generations[0][0].text
-    logger.info(text)
-    if text.startswith("```"):
-        csv_string = extract_code(text)
-    else:
-        csv_string = text
-
-    rows = list(csv.reader(io.StringIO(csv_string)))
-    return await save_graph(rows, Country, City, CapitalRelation)
+    return sum(counts)
 
 
 @flow
@@ -61,21 +65,25 @@ async def async_flow():
     print(f"saved {n} country, capital, pairs")
     rows = csv.reader(open("truth/seed/viewpoints.csv"))
     next(rows)  # skip header
-    # TODO: investigate why refresh=True fails on the next line
-    objs = await save_objs(list(rows), Viewpoint)
+    objs = await save_objs(list(rows), Viewpoint, upsert=True)
     print(f"saved {len(objs)} viewpoints")
-    root_topic = (await save_objs([("Root",)], Topic, True))[0]
+    root_topic = (await save_objs([("Root",)], Topic, upsert=True))[0]
     print(f"root topic: {root_topic}")
     rows = csv.reader(open("truth/seed/topics_level1.csv"))
     next(rows)  # skip header
     objs = await save_graph_prob(root_topic.id, list(rows), Topic, SubtopicOfRelation)
+    top = top_k(root_topic.id, SubtopicOfRelation.TYPE.id, k=5, min_probability=0.05)
+    print(f"top subtopics: {top}")
+    tree = TopicTree(EXTRACTION_POOL, max_depth=TOPIC_TREE_DEPTH)
+    n_topics = await tree.expand(subtopics([root_topic.id]))
+    print(f"topic tree has {n_topics} topics")
+    print(f"llm cache: {LLM_CACHE.stats()}")
     return n
 
 
 def init_edge_types():
-    CapitalRelation()
-    InstanceOf()
-    SubtopicOfRelation()
+    # One round trip registers and loads the types of every imported schema class
+    load_schema_registry()
 
 
 async def async_main():
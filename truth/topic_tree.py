@@ -0,0 +1,203 @@
+# Expands the Topic hierarchy breadth first. All prompts for one level run
+# concurrently through an ExtractionPool, topics are deduplicated against the
+# canonical ids of every saved Topic, and a checkpoint is written after every
+# level so a crash resumes at the level it was on instead of starting over.
+
+import json
+import os
+from functools import partial
+from typing import Dict, List, Tuple
+
+import numpy as np
+from adjacency import ADJACENCY
+from canonical import normalize
+from database import DATABASE_PATH, pooled_connection, run_reader
+from extract import Extraction, ExtractionPool, parse_csv
+from kg import canonicalize, detached, save_instances, save_relations, settle
+from schema.topics import SubtopicOfRelation, Topic
+
+CHECKPOINT_PATH = "topic_tree.json"
+SUBTOPIC_PROMPT = """Be short and complete. List the subtopics of "{topic}" in English
+and the probability that a text about "{topic}" is about each of them, as csv.
+No headers, no explanation. Two columns: subtopic, probability"""
+
+
+def topic_names(ids) -> Dict[int, str]:
+    with pooled_connection() as duck:
+        rows = duck.execute(
+            "SELECT id, name FROM topics WHERE id IN (SELECT unnest(?))",
+            [[int(i) for i in ids]],
+        ).fetchall()
+    return dict(rows)
+
+
+def subtopics(parent_ids) -> List[Tuple[int, str]]:
+    parents = np.asarray(parent_ids, dtype=np.int64)
+    ids = np.unique(ADJACENCY.expand(parents, [SubtopicOfRelation.TYPE.id]))
+    return list(topic_names(ids).items())
+
+
+# Distinct topics within depth levels of the start topics, counting them
+def tree_size(start: List[int], depth: int) -> int:
+    rtype = SubtopicOfRelation.TYPE.id
+    seen = np.unique(np.asarray(start, dtype=np.int64))
+    level = seen
+    for _ in range(depth - 1):
+        level = np.setdiff1d(ADJACENCY.expand(level, [rtype]), seen)
+        seen = np.union1d(seen, level)
+    return len(seen)
+
+
+class TopicTree:
+    def __init__(
+        self,
+        pool: ExtractionPool,
+        max_depth=3,
+        min_probability=0.01,
+        path=CHECKPOINT_PATH,
+    ):
+        self.pool = pool
+        self.max_depth = max_depth
+        self.min_probability = min_probability
+        self.path = path
+        # One line per expanded parent of the current level with the topics it
+        # created, so a resumed level only descends into topics it owns
+        self.created_path = f"{path}.created"
+        self.level = 1
+        self.start: List[int] = []
+        self.frontier: List[Tuple[int, str]] = []
+
+    def checkpoint(self):
+        state = {
+            "database": os.path.abspath(DATABASE_PATH),
+            "start": self.start,
+            "level": self.level,
+            "frontier": self.frontier,
+        }
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{self.path}.tmp", self.path)
+        self.clear_created()
+
+    def clear_created(self):
+        if os.path.exists(self.created_path):
+            os.remove(self.created_path)
+
+    def log_created(self, parent: int, topics: List[Tuple[int, str]]):
+        with open(self.created_path, "a") as f:
+            f.write(json.dumps([parent, topics]) + "\n")
+
+    def read_created(self) -> Dict[int, List[Tuple[int, str]]]:
+        created = {}
+        if os.path.exists(self.created_path):
+            with open(self.created_path) as f:
+                for line in f:
+                    parent, topics = json.loads(line)
+                    created[parent] = [tuple(topic) for topic in topics]
+        return created
+
+    # Only a checkpoint of this database and this first level is resumed, and
+    # only while every topic it names is still saved
+    def restore(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            state = json.load(f)
+        if (
+            state.get("database") != os.path.abspath(DATABASE_PATH)
+            or state.get("start") != self.start
+        ):
+            return False
+        frontier = [tuple(topic) for topic in state["frontier"]]
+        created = self.read_created()
+        topics = frontier + [t for ts in created.values() for t in ts]
+        if topic_names([id for id, _ in topics]) != dict(topics):
+            return False
+        self.level = state["level"]
+        self.frontier = frontier
+        return True
+
+    # frontier holds the (id, name) topics of level 1. A finished tree removes
+    # its checkpoint, so the next run starts over at level 1 and skips the
+    # parents that already have subtopics. Returns the number of topics in the
+    # tree, including those it links to.
+    async def expand(self, frontier: List[Tuple[int, str]]) -> int:
+        self.start = sorted(id for id, _ in frontier)
+        if not self.restore():
+            self.clear_created()
+            self.level = 1
+            self.frontier = list(frontier)
+        while self.level < self.max_depth and self.frontier:
+            self.frontier = await self.expand_level(self.frontier)
+            self.level += 1
+            self.checkpoint()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.clear_created()
+        return tree_size(self.start, self.max_depth)
+
+    async def expand_level(self, frontier) -> List[Tuple[int, str]]:
+        rtype = SubtopicOfRelation.TYPE.id
+        # Parents that already have subtopics were expanded before a crash or
+        # by an earlier run. Only the topics they created carry on, not those
+        # they merely link to.
+        expanded = {id for id, _ in frontier if len(ADJACENCY.neighbors(id, rtype))}
+        created = self.read_created()
+        next_frontier = [topic for id in expanded for topic in created.get(id, ())]
+        extractions = [
+            Extraction(
+                SUBTOPIC_PROMPT.format(topic=name),
+                partial(self.save_subtopics, id, next_frontier),
+            )
+            for id, name in frontier
+            if id not in expanded
+        ]
+        await self.pool.run(extractions)
+        return next_frontier
+
+    async def save_subtopics(self, parent: int, next_frontier, text: str) -> int:
+        names = {}
+        probabilities = {}
+        for row in parse_csv(text):
+            if len(row) < 2:
+                continue
+            try:
+                probability = float(row[1])
+            except ValueError:
+                continue
+            key = normalize(row[0])
+            if not key or key in names or probability < self.min_probability:
+                continue
+            names[key] = row[0].strip()
+            probabilities[key] = probability
+
+        # Topics saved before, in this tree or elsewhere, are linked to but not
+        # expanded again
+        ids, new, held = await run_reader(canonicalize, Topic, list(names.values()))
+        with detached():
+            topics = [Topic(name) for name, _ in held]
+        for topic, (_, id) in zip(topics, held):
+            topic.id = id
+        saved = False
+        try:
+            await save_instances(topics)
+            saved = True
+        finally:
+            settle([(Topic, held)], saved)
+        created = [(id, name) for name, id in new]
+        next_frontier.extend(created)
+        self.log_created(parent, created)
+
+        children = [
+            (id, probability)
+            for id, probability in zip(ids, probabilities.values())
+            if id != parent
+        ]
+        dst = [id for id, _ in children]
+        await save_relations(
+            [parent] * len(dst),
+            SubtopicOfRelation,
+            dst,
+            [probability for _, probability in children],
+        )
+        return len(new)
@@ -0,0 +1,121 @@
+# Multi-hop traversal over relations. Every hop expands the whole frontier in
+# one vectorized step: through the in-memory CSR index for ordinary frontiers,
+# or as a single DuckDB join once the frontier is too large to gather in numpy.
+
+import time
+from datetime import date
+from typing import List
+
+import numpy as np
+from adjacency import ADJACENCY, EDGE_DTYPES, AdjacencyIndex
+from database import pooled_connection
+from pandas import DataFrame
+
+# Frontiers with more ids than this are expanded in DuckDB
+DUCKDB_FRONTIER = 1_000_000
+
+
+def duckdb_expand(frontier, rtypes=None, as_of=None, reverse=False) -> np.ndarray:
+    key, column = ("dst", "src") if reverse else ("src", "dst")
+    conditions = ["TRUE"]
+    if rtypes is not None:
+        conditions.append(f"r.rtype IN ({', '.join(str(int(t)) for t in rtypes)})")
+    if as_of is not None:
+        day = f"DATE '{as_of}'"
+        conditions.append(
+            f"""r.start <= {day}
+            AND {day} < COALESCE(TRY_CAST(r."end" AS DATE), DATE '{date.max}')"""
+        )
+    statement = f"""
+        SELECT r.{column} AS id FROM relations r
+        JOIN _frontier f ON r.{key} = f.id
+        WHERE {" AND ".join(conditions)}
+    """
+    with pooled_connection() as duck:
+        duck.register("_frontier", DataFrame({"id": frontier}))
+        ids = duck.execute(statement).fetchnumpy()["id"]
+        duck.unregister("_frontier")
+    return np.asarray(ids, dtype=np.int64)
+
+
+def expand(frontier, rtypes, as_of, reverse, index) -> np.ndarray:
+    if index is ADJACENCY and len(frontier) > DUCKDB_FRONTIER:
+        return duckdb_expand(frontier, rtypes, as_of, reverse)
+    return index.expand(frontier, rtypes, as_of, reverse)
+
+
+# Breadth-first k-hop traversal. Returns one sorted id array per depth, each
+# holding the nodes first reached at that depth, so cycles are never re-walked.
+def traverse(
+    start,
+    rtypes=None,
+    max_depth=3,
+    as_of=None,
+    reverse=False,
+    index: AdjacencyIndex = ADJACENCY,
+) -> List[np.ndarray]:
+    frontier = np.unique(np.asarray(start, dtype=np.int64))
+    visited = frontier
+    levels = [frontier]
+    for _ in range(max_depth):
+        reached = expand(frontier, rtypes, as_of, reverse, index)
+        frontier = np.setdiff1d(reached, visited)
+        if not len(frontier):
+            break
+        visited = np.union1d(visited, frontier)
+        levels.append(frontier)
+    return levels
+
+
+# Follows a fixed chain of relation types, one hop per entry in path, e.g.
+# [CapitalRelation.TYPE.id, LocatedAtRelation.TYPE.id]
+def follow(
+    start, path: List[int], as_of=None, index: AdjacencyIndex = ADJACENCY
+) -> np.ndarray:
+    frontier = np.unique(np.asarray(start, dtype=np.int64))
+    for rtype in path:
+        if not len(frontier):
+            break
+        frontier = np.unique(expand(frontier, [rtype], as_of, False, index))
+    return frontier
+
+
+def synthetic_index(num_edges, num_nodes, num_rtypes, seed=0) -> AdjacencyIndex:
+    rng = np.random.default_rng(seed)
+    edges = {
+        "src": rng.integers(0, num_nodes, num_edges),
+        "rtype": rng.integers(0, num_rtypes, num_edges),
+        "dst": rng.integers(0, num_nodes, num_edges),
+        "start": np.full(num_edges, np.datetime64("2000-01-01", "D")),
+        "end": np.full(num_edges, np.datetime64(date.max, "D")),
+        "viewpoint": np.zeros(num_edges),
+    }
+    edges = {
+        c: a.astype(dtype) for (c, dtype), a in zip(EDGE_DTYPES.items(), edges.values())
+    }
+    index = AdjacencyIndex(path=None)
+    index._build(edges)
+    index.loaded = True
+    return index
+
+
+def benchmark(num_edges=10_000_000, num_nodes=2_000_000, num_rtypes=8):
+    t = time.perf_counter()
+    index = synthetic_index(num_edges, num_nodes, num_rtypes)
+    print(f"built CSR for {num_edges} edges in {time.perf_counter() - t:.2f}s")
+    start = np.random.default_rng(1).integers(0, num_nodes, 10)
+    for rtypes in (None, [0, 1]):
+        t = time.perf_counter()
+        levels = traverse(start, rtypes=rtypes, max_depth=6, index=index)
+        elapsed = time.perf_counter() - t
+        sizes = [len(level) for level in levels]
+        print(f"rtypes={rtypes} frontier sizes {sizes} in {elapsed * 1000:.1f}ms")
+    t = time.perf_counter()
+    reached = follow(start, [0, 1, 2], index=index)
+    print(
+        f"path [0, 1, 2] reached {len(reached)} in {(time.perf_counter() - t) * 1000:.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,80 @@
+# Per relation type and viewpoint, the edges of every src kept sorted by
+# probability (highest first). Views are materialized from DuckDB on first use
+# and updated in place by the save functions, so top-k queries never re-sort the
+# relations table.
+
+from bisect import bisect_right, insort
+from collections import defaultdict
+from threading import Lock
+from typing import List, Tuple
+
+import numpy as np
+from database import pooled_connection
+
+
+class ProbabilityView:
+    def __init__(self, rtype: int, viewpoint=0):
+        self.rtype = rtype
+        self.viewpoint = viewpoint
+        # src -> ascending (-probability, dst) pairs
+        self.by_src = defaultdict(list)
+        self.load()
+
+    def load(self):
+        statement = """
+            SELECT src, dst, probability FROM relations
+            WHERE rtype = ? AND COALESCE(viewpoint, 0) = ?
+            ORDER BY src, probability DESC, dst
+        """
+        with pooled_connection() as duck:
+            edges = duck.execute(statement, [self.rtype, self.viewpoint]).fetchnumpy()
+        src = np.asarray(edges["src"])
+        keys, starts = np.unique(src, return_index=True)
+        bounds = np.append(starts, len(src))
+        dst = np.asarray(edges["dst"]).tolist()
+        neg = (-np.asarray(edges["probability"], dtype=np.float64)).tolist()
+        for key, lo, hi in zip(keys.tolist(), bounds[:-1], bounds[1:]):
+            self.by_src[key] = list(zip(neg[lo:hi], dst[lo:hi]))
+
+    def add(self, src: int, dst: int, probability: float):
+        insort(self.by_src[src], (-probability, dst))
+
+    def top_k(self, src: int, k=5, min_probability=0.0) -> List[Tuple[int, float]]:
+        edges = self.by_src.get(src, [])
+        # pairs sort on -probability first, so this counts edges >= threshold
+        n = bisect_right(edges, (-min_probability, float("inf")))
+        return [(dst, -neg) for neg, dst in edges[: min(k, n)]]
+
+
+class ProbabilityViews:
+    def __init__(self):
+        self.views = {}
+        self._lock = Lock()
+
+    # Each viewpoint holds its own copy of an edge, so views never mix them
+    def view(self, rtype: int, viewpoint=0) -> ProbabilityView:
+        with self._lock:
+            if (rtype, viewpoint) not in self.views:
+                self.views[(rtype, viewpoint)] = ProbabilityView(rtype, viewpoint)
+            return self.views[(rtype, viewpoint)]
+
+    # Called by the save functions after their commit. Only views that are
+    # already materialized need updating; the rest load the committed rows.
+    def add_edges(self, src, rtype: int, dst, probability=None, viewpoint=0):
+        view = self.views.get((rtype, viewpoint))
+        if view is None:
+            return
+        if probability is None:
+            probability = [1.0] * len(dst)
+        with self._lock:
+            for s, d, p in zip(src, dst, probability):
+                view.add(s, d, float(p))
+
+
+PROBABILITY_VIEWS = ProbabilityViews()
+
+
+def top_k(
+    src: int, rtype: int, k=5, min_probability=0.0, viewpoint=0
+) -> List[Tuple[int, float]]:
+    return PROBABILITY_VIEWS.view(rtype, viewpoint).top_k(src, k, min_probability)